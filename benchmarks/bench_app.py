@@ -0,0 +1,283 @@
+"""End-to-end benchmark of the notes app's routes, with baselines to catch regressions.
+
+It seeds --users users with --notes notes each. Then it runs sessions that log
+in and repeat a round of requests the notes page makes: the listing twice, and
+one add, edit and delete over fetch(). This runs twice:
+
+* ``client``: one session after another through the Flask test client, so
+  every request's MongoDB operations can be attributed to its route;
+* ``server``: --concurrency keep-alive clients against the app served by a
+  threaded WSGI server in this process. With --mongomock the server handles
+  one request at a time, because mongomock is not thread-safe.
+
+It reports throughput, p50/p95/p99 latency and MongoDB operations per request
+for each route, plus the process's peak RSS.
+
+    python benchmarks/bench_app.py --mongomock --save baseline.json
+    python benchmarks/bench_app.py --mongomock --baseline baseline.json
+
+With --baseline, any route that got slower, lost throughput or makes more
+MongoDB operations by more than --tolerance is listed, and the script exits 1.
+Latency baselines only compare on the machine that recorded them.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+from pymongo import monitoring
+from werkzeug.serving import make_server
+
+from common import MongoOpCounter, create_user, load_app, peak_rss_kb, seed_notes, summarize, use_mongomock
+from loadtest import Client
+
+ROUTES = ("login", "index", "add_note", "edit_note", "delete_note")
+PASSWORD = "benchmark"
+JSON = {"Accept": "application/json"}
+
+# (metric, True when a higher value is better) compared against a baseline
+COMPARED = (("rps", True), ("latency_ms_p95", False), ("mongo_ops_per_request", False))
+
+
+class Recorder:
+    """Collects each request's latency, outcome and MongoDB operations by route."""
+
+    def __init__(self, counter, per_request_ops):
+        self.counter = counter
+        self.per_request_ops = per_request_ops
+        self.samples = {route: [] for route in ROUTES}
+        self.errors = dict.fromkeys(ROUTES, 0)
+        self.ops = dict.fromkeys(ROUTES, 0)
+        self.ops_start = counter.count
+        self._lock = threading.Lock()
+
+    def timed(self, route, send, expected):
+        ops_before = self.counter.count
+        start = time.perf_counter()
+        try:
+            status, body = send()
+        except (ConnectionError, OSError):
+            status, body = None, b""
+        elapsed = (time.perf_counter() - start) * 1000
+        ops = self.counter.count - ops_before
+        with self._lock:
+            self.samples[route].append(elapsed)
+            self.errors[route] += status != expected
+            self.ops[route] += ops
+        return body if status == expected else None
+
+    def report(self, elapsed):
+        results = {}
+        for route in ROUTES + ("all",):
+            samples = sum(self.samples.values(), []) if route == "all" else self.samples[route]
+            if not samples:
+                continue
+            stats = summarize(samples)
+            result = {"requests": stats["count"], "rps": stats["count"] / elapsed}
+            result["errors"] = sum(self.errors.values()) if route == "all" else self.errors[route]
+            result.update({"latency_ms_" + key: value for key, value in stats.items() if key != "count"})
+            if route == "all":
+                result["mongo_ops_per_request"] = (self.counter.count - self.ops_start) / stats["count"]
+            elif self.per_request_ops:
+                # Concurrent requests' operations interleave, so only sequential runs split them by route
+                result["mongo_ops_per_request"] = self.ops[route] / stats["count"]
+            results[route] = result
+        return results
+
+
+def run_session(request, email, rounds, recorder):
+    """Log in as ``email`` and run ``rounds`` rounds of the notes page's requests.
+
+    ``request(method, path, form, headers)`` sends one request and returns
+    ``(status, body)``.
+    """
+    recorder.timed("login", lambda: request("POST", "/login", {"email": email, "password": PASSWORD}, None), 302)
+    for i in range(rounds):
+        for _ in range(2):
+            recorder.timed("index", lambda: request("GET", "/", None, None), 200)
+        form = {"note": "Benchmark note %d" % i, "tags": "bench, round%d" % (i % 5), "priority": "Medium"}
+        body = recorder.timed("add_note", lambda: request("POST", "/add_note", form, JSON), 201)
+        if body is None:
+            continue
+        note = json.loads(body)
+        form = dict(form, note_id=note["id"], version=note["version"], note="Edited benchmark note %d" % i)
+        recorder.timed("edit_note", lambda: request("POST", "/edit_note", form, JSON), 200)
+        recorder.timed("delete_note", lambda: request("POST", "/delete_note/" + note["id"], {}, JSON), 200)
+
+
+def bench_client(notes_app, counter, emails, sessions, rounds):
+    recorder = Recorder(counter, per_request_ops=True)
+    started = time.perf_counter()
+    for i in range(sessions):
+        client = notes_app.app.test_client()
+
+        def request(method, path, form, headers):
+            response = client.open(path, method=method, data=form, headers=headers)
+            return response.status_code, response.data
+
+        run_session(request, emails[i % len(emails)], rounds, recorder)
+    return recorder.report(time.perf_counter() - started)
+
+
+def serialized(wsgi_app):
+    """Run one request at a time: mongomock is not safe to use from several threads."""
+    lock = threading.Lock()
+
+    def app(environ, start_response):
+        with lock:
+            body = wsgi_app(environ, start_response)
+            try:
+                return list(body)
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+    return app
+
+
+def bench_server(notes_app, counter, emails, sessions, rounds, concurrency, mongomock):
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    wsgi_app = serialized(notes_app.app) if mongomock else notes_app.app
+    server = make_server("127.0.0.1", 0, wsgi_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:%d" % server.server_port
+
+    work = queue.Queue()
+    for i in range(sessions):
+        work.put(emails[i % len(emails)])
+    recorder = Recorder(counter, per_request_ops=concurrency == 1)
+
+    def worker():
+        while True:
+            try:
+                email = work.get_nowait()
+            except queue.Empty:
+                return
+            client = Client(base_url)
+            run_session(lambda method, path, form, headers: client.request(method, path, form, headers),
+                        email, rounds, recorder)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    return recorder.report(elapsed)
+
+
+def compare(results, baseline, tolerance):
+    """Return a line for every metric that is worse than the baseline by more than ``tolerance``."""
+    regressions = []
+    for mode, routes in results["modes"].items():
+        for route, result in routes.items():
+            before = baseline.get("modes", {}).get(mode, {}).get(route, {})
+            for metric, higher_is_better in COMPARED:
+                if metric not in result or not before.get(metric):
+                    continue
+                change = (result[metric] - before[metric]) / before[metric]
+                if (-change if higher_is_better else change) > tolerance:
+                    regressions.append("%-7s %-12s %-22s %10.2f -> %10.2f (%+.0f%%)" % (
+                        mode, route, metric, before[metric], result[metric], change * 100))
+    return regressions
+
+
+def print_results(results):
+    print("%d users x %d notes, %d sessions of %d rounds" % (
+        results["users"], results["notes"], results["sessions"], results["rounds"]))
+    for mode, routes in results["modes"].items():
+        print()
+        print("%-7s %-12s %9s %7s %9s %9s %9s %10s" % (
+            mode, "route", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms", "mongo ops"))
+        for route, result in routes.items():
+            ops = result.get("mongo_ops_per_request")
+            print("%-7s %-12s %9.1f %7d %9.2f %9.2f %9.2f %10s" % (
+                "", route, result["rps"], result["errors"], result["latency_ms_p50"],
+                result["latency_ms_p95"], result["latency_ms_p99"], "-" if ops is None else "%.2f" % ops))
+    print()
+    print("peak RSS %.1f MB (%.1f MB after seeding)" % (results["peak_rss_mb"], results["seeded_rss_mb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the notes app's routes end to end.")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--notes", type=int, default=1000, help="notes seeded per user")
+    parser.add_argument("--sessions", type=int, default=40, help="login sessions per mode")
+    parser.add_argument("--rounds", type=int, default=10, help="rounds of requests per session")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients in server mode")
+    parser.add_argument("--mode", choices=("client", "server", "both"), default="both")
+    parser.add_argument("--bcrypt-rounds", type=int, default=4,
+                        help="bcrypt cost of the seeded users (the app's default of 12 makes logins dominate)")
+    parser.add_argument("--mongomock", action="store_true", help="use an in-memory mongomock database")
+    parser.add_argument("--mongo-uri", help="MongoDB to seed and query (defaults to MONGO_URI)")
+    parser.add_argument("--save", help="write the results to this JSON file, e.g. as a new baseline")
+    parser.add_argument("--baseline", help="JSON file from an earlier --save to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative change that counts as a regression (default 0.2 = 20%%)")
+    args = parser.parse_args()
+
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+    counter = MongoOpCounter()
+    if not args.mongomock:
+        monitoring.register(counter)
+    # Every session logs in from 127.0.0.1, so lift the login limits but keep the limiter's checks
+    notes_app = load_app(BCRYPT_LOG_ROUNDS=args.bcrypt_rounds, LOGIN_LIMIT_PER_IP=10 ** 9, LOGIN_LIMIT_PER_EMAIL=10 ** 9)
+    if args.mongomock:
+        use_mongomock(notes_app)
+        counter.watch_mongomock()
+
+    emails = ["bench-app-%d@example.com" % i for i in range(args.users)]
+    notes_app.mongo.db.users.delete_many({"email": {"$in": emails}})
+    user_ids = [create_user(notes_app, email=email, password=PASSWORD, rounds=args.bcrypt_rounds)
+                for email in emails]
+    try:
+        for user_id in user_ids:
+            seed_notes(notes_app, user_id, args.notes)
+        seeded_rss_kb = peak_rss_kb()
+
+        modes = ("client", "server") if args.mode == "both" else (args.mode,)
+        results = {
+            "users": args.users, "notes": args.notes, "sessions": args.sessions, "rounds": args.rounds,
+            "concurrency": args.concurrency, "mongomock": args.mongomock, "modes": {},
+        }
+        for mode in modes:
+            if mode == "client":
+                results["modes"][mode] = bench_client(notes_app, counter, emails, args.sessions, args.rounds)
+            else:
+                results["modes"][mode] = bench_server(notes_app, counter, emails, args.sessions, args.rounds,
+                                                      args.concurrency, args.mongomock)
+        results["seeded_rss_mb"] = seeded_rss_kb / 1024
+        results["peak_rss_mb"] = peak_rss_kb() / 1024
+    finally:
+        notes_app.mongo.db.notes.delete_many({"user_id": {"$in": user_ids}})
+        notes_app.mongo.db.note_counts.delete_many({"user_id": {"$in": user_ids}})
+        notes_app.mongo.db.users.delete_many({"_id": {"$in": user_ids}})
+
+    print_results(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        print()
+        settings = [key for key in ("users", "notes", "sessions", "rounds", "concurrency", "mongomock")
+                    if baseline.get(key) != results[key]]
+        if settings:
+            print("Warning: the baseline was recorded with different %s." % ", ".join(settings))
+        if regressions:
+            print("Regressions against %s:" % args.baseline)
+            print("\n".join(regressions))
+            sys.exit(1)
+        print("No regressions against %s (tolerance %.0f%%)." % (args.baseline, args.tolerance * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""TTFB and peak RSS of the notes page, rendered whole versus streamed.
+
+Each mode runs in its own subprocess, because peak RSS only ever grows. The
+subprocess seeds one user with --notes notes (50k by default) and requests /
+with NOTES_PAGE_SIZE=0, so every note is on the page. It reports time to first
+byte, total time and peak RSS growth during the request.
+
+    python benchmarks/bench_stream.py --mongomock
+    python benchmarks/bench_stream.py --mongo-uri mongodb://localhost:27017/notes_bench
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from common import create_user, load_app, peak_rss_kb, seed_notes, use_mongomock
+
+
+def measure(mode, notes, mongomock):
+    notes_app = load_app(
+        INDEX_STREAMING=(mode == "streamed"),
+        NOTES_PAGE_SIZE=0,
+        NOTES_CURSOR_BATCH_SIZE=int(os.environ.get("NOTES_CURSOR_BATCH_SIZE", 500)),
+    )
+    if mongomock:
+        use_mongomock(notes_app)
+    notes_app.mongo.db.users.delete_many({"email": "bench-stream@example.com"})
+    user_id = create_user(notes_app, email="bench-stream@example.com")
+    try:
+        seed_notes(notes_app, user_id, notes)
+        client = notes_app.app.test_client()
+        client.post("/login", data={"email": "bench-stream@example.com", "password": "benchmark"})
+        client.get("/metrics")  # warm up templates and the index bootstrap
+
+        rss_before = peak_rss_kb()
+        started = time.perf_counter()
+        response = client.get("/", buffered=False)
+        body = iter(response.response)
+        size = len(next(body))
+        ttfb = time.perf_counter() - started
+        for chunk in body:
+            size += len(chunk)
+        total = time.perf_counter() - started
+        response.close()
+        return {
+            "mode": mode,
+            "ttfb_ms": ttfb * 1000,
+            "total_ms": total * 1000,
+            "bytes": size,
+            "peak_rss_growth_mb": (peak_rss_kb() - rss_before) / 1024,
+        }
+    finally:
+        notes_app.mongo.db.notes.delete_many({"user_id": user_id})
+        notes_app.mongo.db.users.delete_one({"_id": user_id})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare whole and streamed rendering of the notes page.")
+    parser.add_argument("--notes", type=int, default=50000)
+    parser.add_argument("--mongomock", action="store_true", help="use an in-memory mongomock database")
+    parser.add_argument("--mongo-uri", help="MongoDB to seed and query (defaults to MONGO_URI)")
+    parser.add_argument("--child", choices=("whole", "streamed"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+    if args.child:
+        print(json.dumps(measure(args.child, args.notes, args.mongomock)))
+        return
+
+    results = []
+    for mode in ("whole", "streamed"):
+        command = [sys.executable, os.path.abspath(__file__), "--child", mode, "--notes", str(args.notes)]
+        if args.mongomock:
+            command.append("--mongomock")
+        output = subprocess.run(command, check=True, capture_output=True, text=True, env=os.environ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print("%d notes on one page" % args.notes)
+    print("%-10s %10s %10s %12s %16s" % ("mode", "TTFB ms", "total ms", "MB sent", "peak RSS +MB"))
+    for result in results:
+        print("%-10s %10.1f %10.1f %12.1f %16.1f" % (
+            result["mode"], result["ttfb_ms"], result["total_ms"],
+            result["bytes"] / 1e6, result["peak_rss_growth_mb"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Render time per request of the index page before and after the template cache.
+
+"before" renders through an environment with the template cache disabled, so
+each render parses and compiles the templates again, which is what every
+request paid with render_template_string. "after" renders through the app's
+own environment, where templates are compiled once and reused.
+
+    python benchmarks/bench_templates.py --notes 1000 --iterations 50
+"""
+import argparse
+import time
+
+from flask import g
+
+from common import fake_notes, load_app, summarize
+
+
+def time_renders(env, context, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        env.get_template("index.html").render(context)
+        samples.append((time.perf_counter() - start) * 1000)
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notes", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    notes_app = load_app()
+    app = notes_app.app
+    notes = fake_notes(args.notes)
+
+    with app.test_request_context("/"):
+        g._login_user = notes_app.User(str(notes[0]["user_id"]), "bench@example.com", "Bench")
+        context = {
+            "notes": notes,
+            "next_cursor": None,
+            "priorities": notes_app.NOTE_PRIORITIES,
+            "filters": {"priority": None, "tag": None},
+        }
+        app.update_template_context(context)
+
+        uncached = app.jinja_env.overlay(cache_size=0)
+        app.jinja_env.get_template("index.html")  # warm the cache
+        results = {
+            "before (compile per request)": time_renders(uncached, context, args.iterations),
+            "after (cached templates)": time_renders(app.jinja_env, context, args.iterations),
+        }
+
+    print(f"index page with {args.notes} notes, {args.iterations} renders each (ms)")
+    for label, stats in results.items():
+        print(f"  {label:<30} mean {stats['mean']:7.2f}  p50 {stats['p50']:7.2f}  p95 {stats['p95']:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
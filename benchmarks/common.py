@@ -0,0 +1,140 @@
+"""Helpers shared by the benchmark scripts."""
+import os
+import random
+import statistics
+import sys
+import threading
+from functools import wraps
+
+from bson import ObjectId
+from pymongo import monitoring
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ("meeting project idea groceries budget travel book call email review "
+         "draft plan follow up notes weekly report design fix deploy garden").split()
+
+
+def load_app(**config):
+    """Import the notes app module and apply ``config`` on top of its settings."""
+    os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/notes_bench")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import noteswebappBEST
+    noteswebappBEST.app.config.update(config)
+    return noteswebappBEST
+
+
+def fake_notes(count, user_id=None, seed=0):
+    """Return ``count`` note documents shaped like the ones add_note stores."""
+    rng = random.Random(seed)
+    user_id = user_id or ObjectId()
+    return [{
+        "_id": ObjectId(),
+        "user_id": user_id,
+        "note": " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 40))),
+        "tags": rng.sample(WORDS, rng.randint(0, 3)),
+        "priority": rng.choice(("Low", "Medium", "High")),
+        "version": 1,
+    } for _ in range(count)]
+
+
+def summarize(samples):
+    """Return mean and p50/p95/p99 of ``samples`` (in the samples' unit)."""
+    ordered = sorted(samples)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": pct(50),
+        "p95": pct(95),
+        "p99": pct(99),
+    }
+
+
+def use_mongomock(notes_app):
+    """Point the app's PyMongo handle at an in-memory mongomock database."""
+    import mongomock
+    notes_app.mongo.cx = mongomock.MongoClient()
+    notes_app.mongo.db = notes_app.mongo.cx["notes_bench"]
+    # mongomock has no capped collections; a plain one stands in for note_events
+    notes_app.mongo.db.create_collection("note_events")
+
+
+def create_user(notes_app, email="bench@example.com", password="benchmark", name="Bench", rounds=4):
+    """Insert a user directly and return its id; uses a cheap bcrypt cost by default."""
+    hashed = notes_app.bcrypt.generate_password_hash(password, rounds).decode("utf-8")
+    return notes_app.mongo.db.users.insert_one({"name": name, "email": email, "password": hashed}).inserted_id
+
+
+def seed_notes(notes_app, user_id, count, batch_size=5000):
+    """Insert ``count`` fake notes for ``user_id`` in batches, keeping the tag/priority counts in step."""
+    for start in range(0, count, batch_size):
+        batch = fake_notes(min(batch_size, count - start), user_id=user_id, seed=start)
+        notes_app.mongo.db.notes.insert_many(batch)
+        notes_app.update_note_counts(user_id, batch)
+
+
+class MongoOpCounter(monitoring.CommandListener):
+    """Counts the operations the app sends to MongoDB.
+
+    Against a server it listens for commands; register it with
+    ``pymongo.monitoring.register`` before the app module is imported, so the
+    app's client picks it up. Against mongomock, which sends no commands,
+    ``watch_mongomock`` counts calls to the collection methods instead.
+    """
+
+    MONGOMOCK_OPERATIONS = (
+        "find", "find_one", "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+        "delete_one", "delete_many", "find_one_and_update", "find_one_and_replace", "find_one_and_delete",
+        "bulk_write", "aggregate", "count_documents", "create_index",
+    )
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add(self):
+        with self._lock:
+            self.count += 1
+
+    def started(self, event):
+        self.add()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def watch_mongomock(self):
+        from mongomock.collection import Collection
+
+        for name in self.MONGOMOCK_OPERATIONS:
+            setattr(Collection, name, self._counted(getattr(Collection, name)))
+
+    def _counted(self, method):
+        @wraps(method)
+        def counted(collection, *args, **kwargs):
+            # mongomock implements some operations on top of others: count the outermost only
+            depth = getattr(self._local, "depth", 0)
+            if not depth:
+                self.add()
+            self._local.depth = depth + 1
+            try:
+                return method(collection, *args, **kwargs)
+            finally:
+                self._local.depth = depth
+        return counted
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process so far, in KiB (Linux/macOS)."""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
@@ -0,0 +1,145 @@
+"""Load test comparing the sync (WSGI) and async (ASGI) deployment modes.
+
+Start both modes against the same local mongod, for example
+
+    gunicorn --workers 4 --threads 8 --bind 127.0.0.1:8000 noteswebappBEST:app
+    hypercorn --workers 4 --bind 127.0.0.1:8001 noteswebapp_asgi:app
+
+then run
+
+    python benchmarks/loadtest.py --target sync=http://127.0.0.1:8000 \\
+                                  --target async=http://127.0.0.1:8001
+
+Each target gets a fresh user seeded with --notes notes. Then --concurrency
+clients request the notes page for --duration seconds over keep-alive
+connections. The script reports requests/sec and latency percentiles.
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+import uuid
+from urllib.parse import urlencode, urlsplit
+
+from common import summarize
+
+
+class Client:
+    """Minimal keep-alive HTTP client that carries the session cookie and never follows redirects."""
+
+    def __init__(self, base_url, cookie=None):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.cookie = cookie
+        self.conn = None
+
+    def request(self, method, path, form=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body, headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (ConnectionError, http.client.HTTPException):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        return response.status, data
+
+
+def prepare_user(base_url, notes):
+    """Register and log in a fresh user, seed its notes and return the session cookie."""
+    email = "loadtest-%s@example.com" % uuid.uuid4().hex[:12]
+    client = Client(base_url)
+    client.request("POST", "/register", {"name": "Load Test", "email": email, "password": "loadtest"})
+    status, _ = client.request("POST", "/login", {"email": email, "password": "loadtest"})
+    if status != 302 or not client.cookie:
+        raise SystemExit("Could not log in to %s (HTTP %s)" % (base_url, status))
+    for i in range(notes):
+        client.request("POST", "/add_note", {
+            "note": "Load test note %d" % i,
+            "tags": "load, test",
+            "priority": ("Low", "Medium", "High")[i % 3],
+        })
+    return client.cookie
+
+
+def run_load(base_url, cookie, path, concurrency, duration):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        client = Client(base_url, cookie)
+        own, failed = [], 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                status, _ = client.request("GET", path)
+            except (ConnectionError, http.client.HTTPException, OSError):
+                status = None
+            own.append((time.perf_counter() - start) * 1000)
+            if status != 200:
+                failed += 1
+        with lock:
+            latencies.extend(own)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    result = {"requests": len(latencies), "errors": errors[0], "rps": len(latencies) / elapsed}
+    result.update({"latency_ms_" + key: value for key, value in summarize(latencies).items() if key != "count"})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the sync and async deployment modes under load.")
+    parser.add_argument("--target", action="append", required=True, metavar="NAME=URL",
+                        help="deployment to test, e.g. sync=http://127.0.0.1:8000 (repeatable)")
+    parser.add_argument("--notes", type=int, default=200, help="notes seeded for the test user")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per target")
+    parser.add_argument("--path", default="/")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for target in args.target:
+        name, _, url = target.partition("=")
+        cookie = prepare_user(url, args.notes)
+        results[name] = run_load(url, cookie, args.path, args.concurrency, args.duration)
+
+    print("%-10s %10s %8s %10s %10s %10s" % ("mode", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms"))
+    for name, result in results.items():
+        print("%-10s %10.1f %8d %10.1f %10.1f %10.1f" % (
+            name, result["rps"], result["errors"],
+            result["latency_ms_p50"], result["latency_ms_p95"], result["latency_ms_p99"]))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
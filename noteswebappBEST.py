@@ -1,22 +1,969 @@
-from flask import Flask, request, redirect, render_template_string, flash, url_for
+from flask import Flask, request, redirect, render_template, flash, url_for, abort, jsonify, g, has_app_context
+from flask import before_render_template, template_rendered, got_request_exception
+from flask import Response, stream_with_context, get_flashed_messages, session, make_response, send_file
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
 from flask_pymongo import PyMongo
 from bson import ObjectId
 from flask_bcrypt import Bcrypt
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
+from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user, login_url
+from pymongo import InsertOne, UpdateOne, DeleteOne, ReturnDocument, ReadPreference, CursorType, monitoring
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
 from dotenv import load_dotenv
+from jinja2 import DictLoader, FileSystemBytecodeCache
+from markupsafe import Markup, escape
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from operator import itemgetter
+from werkzeug.datastructures import CallbackDict
+from werkzeug.exceptions import NotFound
+from werkzeug.utils import secure_filename
+from werkzeug.wsgi import FileWrapper
+from urllib.parse import quote
+import bisect
+import click
+import csv
+import gridfs
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import mimetypes
+import math
 import os
+import queue
+import re
+import secrets
+import sys
+import tempfile
+import threading
+import time
+import traceback
 
 app = Flask(__name__)
 load_dotenv()
 app.config["MONGO_URI"] = os.getenv("MONGO_URI")
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY")
+# Connection pool per process; MONGO_WAIT_QUEUE_TIMEOUT_MS bounds how long a request waits for a connection
+app.config["MONGO_MAX_POOL_SIZE"] = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+app.config["MONGO_MIN_POOL_SIZE"] = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"] = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 0)) or None
+# Read preference of the notes listings and search, e.g. "secondaryPreferred" to offload them
+# from the primary; they may then lag behind the user's latest writes by the replication delay
+app.config["MONGO_LISTING_READ_PREFERENCE"] = os.getenv("MONGO_LISTING_READ_PREFERENCE", "primary")
+app.config["NOTES_PAGE_SIZE"] = int(os.getenv("NOTES_PAGE_SIZE", 30))
+# Stream the notes page to the client while the cursor is drained instead of rendering it whole.
+# With streaming on, NOTES_PAGE_SIZE=0 lists every note on one page.
+app.config["INDEX_STREAMING"] = os.getenv("INDEX_STREAMING", "false").lower() == "true"
+app.config["NOTES_CURSOR_BATCH_SIZE"] = int(os.getenv("NOTES_CURSOR_BATCH_SIZE", 500))
+# Template output pieces collected before each write while streaming
+app.config["STREAM_BUFFER_SIZE"] = int(os.getenv("STREAM_BUFFER_SIZE", 32))
+# "memory" searches an in-process inverted index per user, with prefix matching. "mongo" uses
+# the collection's text index: always current across workers, but whole stemmed words only.
+app.config["SEARCH_BACKEND"] = os.getenv("SEARCH_BACKEND", "memory")
+app.config["SEARCH_RESULTS_LIMIT"] = int(os.getenv("SEARCH_RESULTS_LIMIT", 50))
+app.config["SEARCH_INDEX_MAX_USERS"] = int(os.getenv("SEARCH_INDEX_MAX_USERS", 100))
+app.config["API_BULK_MAX_OPERATIONS"] = int(os.getenv("API_BULK_MAX_OPERATIONS", 1000))
+# Most used tags listed in the notes page sidebar
+app.config["TAG_SUMMARY_LIMIT"] = int(os.getenv("TAG_SUMMARY_LIMIT", 50))
+# Notes per insert_many batch of an import, and the largest upload an import accepts
+app.config["IMPORT_BATCH_SIZE"] = int(os.getenv("IMPORT_BATCH_SIZE", 1000))
+app.config["IMPORT_MAX_BYTES"] = int(os.getenv("IMPORT_MAX_BYTES", 512 * 1024 * 1024))
+app.config["IMPORT_WORKERS"] = int(os.getenv("IMPORT_WORKERS", 2))
+# Where uploads wait for their import job (default: the system temp directory)
+app.config["IMPORT_SPOOL_DIR"] = os.getenv("IMPORT_SPOOL_DIR") or None
+app.config["ATTACHMENT_MAX_BYTES"] = int(os.getenv("ATTACHMENT_MAX_BYTES", 25 * 1024 * 1024))
+# Image thumbnails are made on first request and kept on disk, least recently used evicted first
+app.config["THUMBNAIL_SIZE"] = int(os.getenv("THUMBNAIL_SIZE", 256))
+app.config["THUMBNAIL_CACHE_DIR"] = os.getenv("THUMBNAIL_CACHE_DIR", os.path.join(tempfile.gettempdir(), "notes-thumbnails"))
+app.config["THUMBNAIL_CACHE_MAX_BYTES"] = int(os.getenv("THUMBNAIL_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Push note changes to open tabs over server-sent events. Each process follows the capped
+# note_events collection with a change stream ("auto" falls back to polling on a standalone mongod).
+# Off by default: a sync worker thread is held per open tab, so route /events to the async app first.
+app.config["LIVE_UPDATES"] = os.getenv("LIVE_UPDATES", "false").lower() == "true"
+app.config["LIVE_UPDATES_SOURCE"] = os.getenv("LIVE_UPDATES_SOURCE", "auto")
+app.config["NOTE_EVENTS_MAX_BYTES"] = int(os.getenv("NOTE_EVENTS_MAX_BYTES", 16 * 1024 * 1024))
+app.config["SSE_HEARTBEAT_SECONDS"] = int(os.getenv("SSE_HEARTBEAT_SECONDS", 15))
+# bcrypt work factor; existing hashes made with another cost are upgraded on login
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.getenv("BCRYPT_LOG_ROUNDS", 12))
+app.config["HASH_POOL_WORKERS"] = int(os.getenv("HASH_POOL_WORKERS", os.cpu_count() or 2))
+# Hashes queued or running at once before new logins/registrations get a 503
+app.config["HASH_POOL_QUEUE_SIZE"] = int(os.getenv("HASH_POOL_QUEUE_SIZE", 64))
+app.config["USER_CACHE_SIZE"] = int(os.getenv("USER_CACHE_SIZE", 10000))
+app.config["USER_CACHE_TTL"] = int(os.getenv("USER_CACHE_TTL", 300))
+# "cookie" keeps Flask's signed cookie sessions. "memory", "file" and "redis" keep sessions
+# server side, and the file and Redis stores also share cached users between workers.
+app.config["SESSION_BACKEND"] = os.getenv("SESSION_BACKEND", "cookie")
+app.config["SESSION_TTL"] = int(os.getenv("SESSION_TTL", 14 * 24 * 3600))
+app.config["SESSION_FILE_DIR"] = os.getenv("SESSION_FILE_DIR", os.path.join(tempfile.gettempdir(), "notes-sessions"))
+app.config["SESSION_REDIS_URL"] = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+# Sliding-window limits on login and registration attempts, checked before any database or bcrypt work.
+# "memory" counts per process; "redis" shares the counts between workers and hosts.
+app.config["RATE_LIMIT_ENABLED"] = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+app.config["RATE_LIMIT_BACKEND"] = os.getenv("RATE_LIMIT_BACKEND", "memory")
+app.config["RATE_LIMIT_REDIS_URL"] = os.getenv("RATE_LIMIT_REDIS_URL", app.config["SESSION_REDIS_URL"])
+app.config["RATE_LIMIT_WINDOW"] = int(os.getenv("RATE_LIMIT_WINDOW", 60))
+app.config["LOGIN_LIMIT_PER_IP"] = int(os.getenv("LOGIN_LIMIT_PER_IP", 20))
+app.config["LOGIN_LIMIT_PER_EMAIL"] = int(os.getenv("LOGIN_LIMIT_PER_EMAIL", 10))
+app.config["REGISTER_LIMIT_PER_IP"] = int(os.getenv("REGISTER_LIMIT_PER_IP", 5))
+app.config["REGISTER_LIMIT_PER_EMAIL"] = int(os.getenv("REGISTER_LIMIT_PER_EMAIL", 3))
+# Failed logins in a row before an account is locked; each further failure doubles the lock
+app.config["LOCKOUT_THRESHOLD"] = int(os.getenv("LOCKOUT_THRESHOLD", 5))
+app.config["LOCKOUT_BASE_SECONDS"] = int(os.getenv("LOCKOUT_BASE_SECONDS", 30))
+app.config["LOCKOUT_MAX_SECONDS"] = int(os.getenv("LOCKOUT_MAX_SECONDS", 3600))
+app.config["PRECOMPILE_TEMPLATES"] = os.getenv("PRECOMPILE_TEMPLATES", "false").lower() == "true"
+# Optional directory for Jinja's on-disk bytecode cache, shared by worker processes
+app.config["TEMPLATE_BYTECODE_CACHE_DIR"] = os.getenv("TEMPLATE_BYTECODE_CACHE_DIR")
+
+app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN")
+# Requests slower than this get their sampled stacks logged; 0 turns the profiler off
+app.config["PROFILE_SLOW_REQUEST_MS"] = int(os.getenv("PROFILE_SLOW_REQUEST_MS", 0))
+app.config["PROFILE_SAMPLE_INTERVAL_MS"] = int(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", 5))
+
+# Metrics
+class Histogram:
+    """Prometheus-style histogram with cumulative ``le`` buckets, in seconds."""
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """Process-local counters and histograms rendered in the Prometheus text format.
+
+    Each worker process keeps its own numbers; scrape every worker (or sum
+    them in Prometheus) for a whole-deployment view.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self.collectors = []  # callables returning (name, type, labels, value) gauge/counter samples
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def render(self):
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append((labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                cumulative = 0
+                for bound, count in zip(self.BUCKET_LABELS, histogram.counts):
+                    cumulative += count
+                    samples.setdefault(name, []).append((labels + (("le", bound),), cumulative, "_bucket"))
+                samples[name].append((labels, histogram.sum, "_sum"))
+                samples[name].append((labels, histogram.count, "_count"))
+        for collect in self.collectors:
+            for name, kind, labels, value in collect():
+                self._help.setdefault(name, (kind, ""))
+                samples.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+
+        lines = []
+        for name in sorted(samples):
+            kind, text = self._help.get(name, ("untyped", ""))
+            if text:
+                lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value, *suffix in samples[name]:
+                label_text = ",".join('%s="%s"' % (key, str(val).replace('"', '\\"')) for key, val in labels)
+                lines.append("%s%s%s %s" % (name, suffix[0] if suffix else "",
+                                            "{%s}" % label_text if label_text else "", repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+    BUCKET_LABELS = tuple(repr(float(bound)) for bound in Histogram.BUCKETS) + ("+Inf",)
+
+metrics = MetricsRegistry()
+metrics.describe("notes_http_requests_total", "counter", "HTTP requests by endpoint, method and status.")
+metrics.describe("notes_http_request_duration_seconds", "histogram", "HTTP request latency by endpoint.")
+metrics.describe("notes_http_request_phase_seconds", "histogram",
+                 "Time spent per request in mongo, template rendering and bcrypt, by endpoint.")
+metrics.describe("notes_mongo_command_duration_seconds", "histogram", "MongoDB command latency by command.")
+metrics.describe("notes_mongo_command_failures_total", "counter", "Failed MongoDB commands by command.")
+metrics.describe("notes_template_render_seconds", "histogram", "Template render time by template.")
+metrics.describe("notes_password_hash_seconds", "histogram", "bcrypt latency including time queued for the pool.")
+metrics.describe("notes_imported_notes_total", "counter", "Notes inserted by import jobs.")
+metrics.describe("notes_import_jobs_total", "counter", "Finished import jobs by status.")
+metrics.describe("notes_rate_limit_rejected_total", "counter",
+                 "Login and registration attempts rejected by the rate limiter, by action and key.")
+metrics.describe("notes_account_lockouts_total", "counter", "Accounts locked after repeated failed logins.")
+
+def add_request_time(phase, seconds):
+    """Attribute ``seconds`` of the current request's time to ``phase``."""
+    if has_app_context():
+        phases = g.setdefault("request_phases", {})
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Times every command sent by the PyMongo client."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        seconds = event.duration_micros / 1e6
+        metrics.observe("notes_mongo_command_duration_seconds", seconds, command=event.command_name)
+        add_request_time("mongo", seconds)
+
+    def failed(self, event):
+        seconds = event.duration_micros / 1e6
+        metrics.observe("notes_mongo_command_duration_seconds", seconds, command=event.command_name)
+        metrics.inc("notes_mongo_command_failures_total", command=event.command_name)
+        add_request_time("mongo", seconds)
+
+class SlowRequestProfiler:
+    """Opt-in sampling profiler: snapshots request threads' stacks every few milliseconds.
+
+    When a request ends slower than PROFILE_SLOW_REQUEST_MS its most frequent
+    stacks are handed to ``on_slow_request`` (by default, logged as a warning).
+    """
+
+    def __init__(self):
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+        self.on_slow_request = self.log_profile
+
+    def begin(self):
+        with self._lock:
+            self._stacks[threading.get_ident()] = Counter()
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name="slow-request-profiler", daemon=True)
+                self._sampler.start()
+
+    def end(self):
+        with self._lock:
+            return self._stacks.pop(threading.get_ident(), None)
+
+    def _sample(self):
+        while True:
+            time.sleep(app.config["PROFILE_SAMPLE_INTERVAL_MS"] / 1000)
+            with self._lock:
+                if not self._stacks:
+                    continue
+                frames = sys._current_frames()
+                for ident, stacks in self._stacks.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        summary = traceback.extract_stack(frame, limit=40)
+                        stacks[tuple("%s:%d %s" % (f.filename, f.lineno, f.name) for f in summary)] += 1
+
+    @staticmethod
+    def log_profile(endpoint, seconds, stacks):
+        lines = ["Slow request %s took %.0f ms; most sampled stacks:" % (endpoint, seconds * 1000)]
+        for stack, count in stacks.most_common(5):
+            lines.append("  %d samples:" % count)
+            lines.extend("    " + frame for frame in stack[-8:])
+        app.logger.warning("\n".join(lines))
+
+profiler = SlowRequestProfiler()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if app.config["PROFILE_SLOW_REQUEST_MS"]:
+        profiler.begin()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or "unknown"
+        metrics.inc("notes_http_requests_total", endpoint=endpoint, method=request.method,
+                    status=response.status_code)
+        metrics.observe("notes_http_request_duration_seconds", elapsed, endpoint=endpoint)
+        for phase, seconds in g.get("request_phases", {}).items():
+            metrics.observe("notes_http_request_phase_seconds", seconds, endpoint=endpoint, phase=phase)
+        if app.config["PROFILE_SLOW_REQUEST_MS"]:
+            stacks = profiler.end()
+            if stacks and elapsed * 1000 >= app.config["PROFILE_SLOW_REQUEST_MS"]:
+                profiler.on_slow_request(endpoint, elapsed, stacks)
+    return response
+
+@got_request_exception.connect_via(app)
+def record_request_exception(sender, exception, **extra):
+    # Unless the exception propagates, Flask answers 500 through record_request_metrics, which counts it
+    propagate = app.config["PROPAGATE_EXCEPTIONS"]
+    if propagate is None:
+        propagate = app.testing or app.debug
+    if not propagate:
+        return
+    metrics.inc("notes_http_requests_total", endpoint=request.endpoint or "unknown",
+                method=request.method, status=500)
+    if app.config["PROFILE_SLOW_REQUEST_MS"]:
+        profiler.end()
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.setdefault("render_started", []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def record_render_time(sender, template, context, **extra):
+    if g.get("render_started"):
+        seconds = time.perf_counter() - g.render_started.pop()
+        metrics.observe("notes_template_render_seconds", seconds, template=template.name)
+        add_request_time("render", seconds)
 
 # Initialize extensions
-mongo = PyMongo(app)
+mongo = PyMongo(
+    app,
+    maxPoolSize=app.config["MONGO_MAX_POOL_SIZE"],
+    minPoolSize=app.config["MONGO_MIN_POOL_SIZE"],
+    waitQueueTimeoutMS=app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"],
+    event_listeners=[MongoCommandTimer()],
+)
 bcrypt = Bcrypt(app)
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 
+def wants_json():
+    """True for the page's fetch() calls, which ask for JSON instead of a redirect."""
+    return request.accept_mimetypes.best == "application/json"
+
+@login_manager.unauthorized_handler
+def unauthorized():
+    """JSON 401 for API clients, the usual redirect to the login page for browsers."""
+    if request.path.startswith("/api/") or wants_json():
+        return jsonify(error="Authentication required."), 401
+    flash(login_manager.login_message, login_manager.login_message_category)
+    return redirect(login_url(login_manager.login_view, next_url=request.url))
+
+NOTE_PRIORITIES = ("Low", "Medium", "High")
+# Fields the note cards render
+NOTE_CARD_FIELDS = {"note": 1, "tags": 1, "priority": 1, "version": 1, "attachments": 1}
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+def listing_notes():
+    """The notes collection with the read preference configured for listings and search."""
+    return mongo.db.notes.with_options(
+        read_preference=READ_PREFERENCES[app.config["MONGO_LISTING_READ_PREFERENCE"]]
+    )
+
+def ensure_indexes():
+    """Create the indexes the app's queries rely on."""
+    try:
+        mongo.db.users.create_index("email", unique=True)
+    except (DuplicateKeyError, OperationFailure) as e:
+        # Existing duplicate emails; the app still works, registration is just racy until cleaned up
+        app.logger.error("Could not create the unique index on users.email: %s", e)
+    mongo.db.notes.create_index([("user_id", 1), ("_id", -1)])
+    mongo.db.notes.create_index([("user_id", 1), ("priority", 1), ("_id", -1)])
+    mongo.db.notes.create_index([("user_id", 1), ("tags", 1), ("_id", -1)])
+    if app.config["SEARCH_BACKEND"] == "mongo":
+        mongo.db.notes.create_index(
+            [("user_id", 1), ("note", "text"), ("tags", "text")],
+            weights={"note": 1, "tags": 2},
+            name="notes_text",
+        )
+    mongo.db.note_counts.create_index([("user_id", 1), ("kind", 1), ("key", 1)], unique=True)
+    mongo.db.note_counts.create_index([("user_id", 1), ("kind", 1), ("count", -1)])
+    mongo.db.import_jobs.create_index("finished", expireAfterSeconds=IMPORT_JOB_TTL)
+    mongo.db.notes.create_index("attachments.id", sparse=True)
+    mongo.db["attachments.files"].create_index("metadata.note_id")
+    if app.config["LIVE_UPDATES"]:
+        if "note_events" not in mongo.db.list_collection_names():
+            try:
+                mongo.db.create_collection("note_events", capped=True, size=app.config["NOTE_EVENTS_MAX_BYTES"])
+            except CollectionInvalid:
+                pass  # created by another process meanwhile
+        mongo.db.note_events.create_index([("user_id", 1), ("_id", 1)])
+
+_indexes_ready = False
+
+@app.before_request
+def bootstrap_indexes():
+    """Make sure the indexes exist once per process, before the first request."""
+    global _indexes_ready
+    if not _indexes_ready:
+        ensure_indexes()
+        _indexes_ready = True
+
+# Password hashing
+class HashPoolFull(Exception):
+    """Raised when the password hashing pool has no room for another job."""
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded pool of worker threads instead of the request threads.
+
+    bcrypt releases the GIL while hashing, so threads give real parallelism.
+    At most HASH_POOL_QUEUE_SIZE jobs may be queued or running; beyond that
+    ``submit`` raises HashPoolFull straight away rather than letting requests
+    pile up behind a login storm.
+    """
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+        self.depth = 0
+        self.rejected = 0
+        self.completed = 0
+        self.seconds_total = 0.0
+        self.seconds_max = 0.0
+
+    def submit(self, fn, *args):
+        """Queue ``fn(*args)`` on the pool and return its Future."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashPoolFull()
+        with self._lock:
+            self.depth += 1
+        queued_at = time.perf_counter()
+
+        def job():
+            try:
+                return fn(*args)
+            finally:
+                # Latency as the caller sees it: queue wait plus hashing
+                elapsed = time.perf_counter() - queued_at
+                metrics.observe("notes_password_hash_seconds", elapsed)
+                with self._lock:
+                    self.depth -= 1
+                    self.completed += 1
+                    self.seconds_total += elapsed
+                    self.seconds_max = max(self.seconds_max, elapsed)
+                self._slots.release()
+
+        return self._executor.submit(job)
+
+    def run(self, fn, *args):
+        """Run ``fn(*args)`` on the pool and wait for the result."""
+        started = time.perf_counter()
+        try:
+            return self.submit(fn, *args).result()
+        finally:
+            add_request_time("bcrypt", time.perf_counter() - started)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "depth": self.depth,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "seconds_total": self.seconds_total,
+                "seconds_max": self.seconds_max,
+            }
+
+password_hasher = PasswordHasher(app.config["HASH_POOL_WORKERS"], app.config["HASH_POOL_QUEUE_SIZE"])
+
+def bcrypt_hash(password):
+    """Hash ``password`` with the configured work factor on the calling thread."""
+    return bcrypt.generate_password_hash(password, app.config["BCRYPT_LOG_ROUNDS"]).decode('utf-8')
+
+def hash_password(password):
+    """Return the bcrypt hash of ``password`` as a string, computed on the hashing pool."""
+    return password_hasher.run(bcrypt_hash, password)
+
+def check_password(hashed_password, password):
+    """Check ``password`` against a stored bcrypt hash on the hashing pool."""
+    return password_hasher.run(bcrypt.check_password_hash, hashed_password, password)
+
+def needs_rehash(hashed_password):
+    """True when a hash was made with a different work factor than BCRYPT_LOG_ROUNDS."""
+    try:
+        rounds = int(hashed_password.split("$")[2])
+    except (IndexError, ValueError):
+        return True
+    return rounds != app.config["BCRYPT_LOG_ROUNDS"]
+
+def upgrade_password_hash(user, password):
+    """Re-hash a just-verified password with the current work factor, if it changed."""
+    if not needs_rehash(user["password"]):
+        return
+    try:
+        new_hash = hash_password(password)
+    except HashPoolFull:
+        return  # try again on a later login
+    # Only replace the hash we verified, in case the password changed meanwhile
+    mongo.db.users.update_one({"_id": user["_id"], "password": user["password"]},
+                              {"$set": {"password": new_hash}})
+
+@app.errorhandler(HashPoolFull)
+def hash_pool_full(e):
+    return "The server is busy, please try again in a moment.", 503, {"Retry-After": "1"}
+
+# Rate limiting
+class RateLimited(Exception):
+    """Raised when an attempt is over a rate limit or for a locked account."""
+
+    def __init__(self, retry_after):
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__("Too many attempts, please try again in %d seconds." % self.retry_after)
+
+def lockout_seconds(failures):
+    """How long an account stays locked after ``failures`` failed logins in a row."""
+    excess = failures - app.config["LOCKOUT_THRESHOLD"]
+    if excess < 0:
+        return 0
+    return min(app.config["LOCKOUT_MAX_SECONDS"], app.config["LOCKOUT_BASE_SECONDS"] * 2 ** min(excess, 32))
+
+def window_retry_after(previous, count, limit, fraction, window):
+    """Seconds until a key over ``limit`` may make another attempt."""
+    # The older window's weight has to fade until the estimate drops below the limit
+    if count >= limit:
+        return (1 - fraction + 1 - limit / max(count, 1)) * window
+    return (1 - (limit - count) / previous - fraction) * window
+
+class MemoryRateLimiter:
+    """Sliding-window counters and account lockouts kept in this process.
+
+    Each key keeps the number of attempts in the current and the previous
+    fixed window. The attempts in the last ``window`` seconds are estimated
+    by weighting the previous window by how much of it still overlaps. A
+    ``hit`` is one dict lookup under a lock, around 2 µs in CPython. Entries
+    idle for two windows are dropped by a sweep every SWEEP_EVERY new windows.
+    """
+
+    SWEEP_EVERY = 10000
+    shared = False
+
+    def __init__(self, window):
+        self.window = window
+        self._windows = {}
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._rolled = 0
+        self.allowed = 0
+
+    def hit(self, key, limit):
+        """Count an attempt for the tuple ``key``; return 0, or the seconds to wait if it is over ``limit``."""
+        position = time.monotonic() / self.window
+        current = int(position)
+        fraction = position - current
+        with self._lock:
+            entry = self._windows.get(key)
+            if entry is None or entry[0] != current:
+                entry = self._roll(key, entry, current)
+            _, count, previous = entry
+            if previous * (1 - fraction) + count >= limit:
+                return window_retry_after(previous, count, limit, fraction, self.window)
+            entry[1] = count + 1
+            self.allowed += 1
+            return 0
+
+    def _roll(self, key, entry, current):
+        """Start ``key``'s entry for the window ``current``; called with the lock held."""
+        previous = entry[1] if entry and entry[0] == current - 1 else 0
+        entry = self._windows[key] = [current, 0, previous]
+        self._rolled += 1
+        if self._rolled % self.SWEEP_EVERY == 0:
+            self._sweep(current)
+        return entry
+
+    def locked(self, key):
+        """Seconds left on ``key``'s lockout, or 0."""
+        entry = self._failures.get(key)
+        return max(0, entry[1] - time.monotonic()) if entry else 0
+
+    def failed(self, key):
+        """Record a failed login; return the seconds of the lockout it starts, or 0."""
+        now = time.monotonic()
+        with self._lock:
+            failures, _, last = self._failures.get(key, (0, 0, now))
+            if now - last > app.config["LOCKOUT_MAX_SECONDS"]:
+                failures = 0
+            failures += 1
+            seconds = lockout_seconds(failures)
+            self._failures[key] = (failures, now + seconds, now)
+        return seconds
+
+    def succeeded(self, key):
+        if key in self._failures:
+            with self._lock:
+                self._failures.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"allowed": self.allowed, "keys": len(self._windows)}
+
+    def _sweep(self, current):
+        for key in [key for key, entry in self._windows.items() if entry[0] < current - 1]:
+            del self._windows[key]
+        now = time.monotonic()
+        for key in [key for key, entry in self._failures.items()
+                    if now - entry[2] > app.config["LOCKOUT_MAX_SECONDS"]]:
+            del self._failures[key]
+
+class RedisRateLimiter:
+    """The same sliding windows and lockouts in Redis, shared by every worker and host.
+
+    ``hit`` is one pipelined round trip, plus a DECR when the attempt is
+    rejected, and ``locked`` is one GET. Takes a redis-py compatible client,
+    so tests can pass a fakeredis one.
+    """
+
+    shared = True
+
+    def __init__(self, client, window, prefix="notes:rate:"):
+        self.client = client
+        self.window = window
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.allowed = 0
+
+    def hit(self, key, limit):
+        position = time.time() / self.window
+        current = int(position)
+        fraction = position - current
+        name = self.prefix + ":".join(key)
+        counter = "%s:%d" % (name, current)
+        pipe = self.client.pipeline()
+        pipe.incr(counter)
+        pipe.expire(counter, self.window * 2)
+        pipe.get("%s:%d" % (name, current - 1))
+        count, _, previous = pipe.execute()
+        count, previous = count - 1, int(previous or 0)
+        if previous * (1 - fraction) + count >= limit:
+            self.client.decr(counter)  # rejected attempts do not count
+            return window_retry_after(previous, count, limit, fraction, self.window)
+        with self._lock:
+            self.allowed += 1
+        return 0
+
+    def locked(self, key):
+        until = self.client.get(self.prefix + "locked:" + key)
+        return max(0, float(until) - time.time()) if until else 0
+
+    def failed(self, key):
+        failures_key = self.prefix + "failures:" + key
+        pipe = self.client.pipeline()
+        pipe.incr(failures_key)
+        pipe.expire(failures_key, app.config["LOCKOUT_MAX_SECONDS"])
+        failures, _ = pipe.execute()
+        seconds = lockout_seconds(failures)
+        if seconds:
+            self.client.set(self.prefix + "locked:" + key, time.time() + seconds, ex=math.ceil(seconds))
+        return seconds
+
+    def succeeded(self, key):
+        self.client.delete(self.prefix + "failures:" + key, self.prefix + "locked:" + key)
+
+    def stats(self):
+        with self._lock:
+            return {"allowed": self.allowed}
+
+def make_rate_limiter(backend):
+    """Build the limiter for RATE_LIMIT_BACKEND, or None when rate limiting is off."""
+    if not app.config["RATE_LIMIT_ENABLED"]:
+        return None
+    if backend == "memory":
+        return MemoryRateLimiter(app.config["RATE_LIMIT_WINDOW"])
+    if backend == "redis":
+        import redis  # only needed for this backend
+        return RedisRateLimiter(redis.Redis.from_url(app.config["RATE_LIMIT_REDIS_URL"]),
+                                app.config["RATE_LIMIT_WINDOW"])
+    raise ValueError("Unknown RATE_LIMIT_BACKEND %r." % backend)
+
+rate_limiter = make_rate_limiter(app.config["RATE_LIMIT_BACKEND"])
+
+# Attempts allowed per RATE_LIMIT_WINDOW, by action: (per client IP, per email)
+RATE_LIMITS = {
+    "login": ("LOGIN_LIMIT_PER_IP", "LOGIN_LIMIT_PER_EMAIL"),
+    "register": ("REGISTER_LIMIT_PER_IP", "REGISTER_LIMIT_PER_EMAIL"),
+}
+
+def account_key(email):
+    return (email or "").strip().lower()
+
+def check_rate_limits(action, ip, email):
+    """Count an attempt at ``action``, raising RateLimited if its IP, email or account may not try now.
+
+    Runs before anything else the attempt would cost, so rejected attempts
+    never reach MongoDB or bcrypt.
+    """
+    if rate_limiter is None:
+        return
+    email = account_key(email)
+    if action == "login":
+        retry_after = rate_limiter.locked(email)
+        if retry_after:
+            metrics.inc("notes_rate_limit_rejected_total", action=action, key="lockout")
+            raise RateLimited(retry_after)
+    ip_limit, email_limit = RATE_LIMITS[action]
+    for scope, value, limit in (("ip", ip, ip_limit), ("email", email, email_limit)):
+        retry_after = rate_limiter.hit((action, scope, value), app.config[limit])
+        if retry_after:
+            metrics.inc("notes_rate_limit_rejected_total", action=action, key=scope)
+            raise RateLimited(retry_after)
+
+def login_failed(email):
+    """Count a failed login towards locking the account."""
+    if rate_limiter is not None and rate_limiter.failed(account_key(email)):
+        metrics.inc("notes_account_lockouts_total")
+
+def login_succeeded(email):
+    if rate_limiter is not None:
+        rate_limiter.succeeded(account_key(email))
+
+@app.errorhandler(RateLimited)
+def rate_limited(e):
+    """Show the form again with the message, like any other failed login or registration."""
+    flash(str(e), "danger")
+    return render_template(request.endpoint + ".html"), 429, {"Retry-After": str(e.retry_after)}
+
+# Server-side sessions
+class MemoryStore:
+    """Process-local key/value store with a TTL per key.
+
+    Expired keys are dropped when read and by a sweep every SWEEP_EVERY writes.
+    """
+
+    SWEEP_EVERY = 1000
+    shared = False
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._writes += 1
+            if self._writes % self.SWEEP_EVERY == 0:
+                now = time.monotonic()
+                for expired in [key for key, (_, expires) in self._entries.items() if expires <= now]:
+                    del self._entries[expired]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+class FileStore:
+    """One file per key in a directory, shared by the worker processes of a host.
+
+    Each file starts with its expiry time. Expired files are removed when read
+    and by a sweep every SWEEP_EVERY writes of a process.
+    """
+
+    SWEEP_EVERY = 1000
+    shared = True
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._writes = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                expires, _, value = f.read().partition(b"\n")
+        except FileNotFoundError:
+            return None
+        if float(expires) <= time.time():
+            self._remove(path)
+            return None
+        return value
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        return self._read(self._path(key))
+
+    def set(self, key, value, ttl):
+        # Write then rename, so readers in other processes never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"%f\n" % (time.time() + ttl) + value)
+        os.replace(temp_path, self._path(key))
+        self._writes += 1
+        if self._writes % self.SWEEP_EVERY == 0:
+            for name in os.listdir(self.directory):
+                if not name.startswith("."):
+                    self._read(os.path.join(self.directory, name))
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+class RedisStore:
+    """Keys in Redis, or any server speaking its protocol, which expires them itself.
+
+    Takes a redis-py compatible client, so tests can pass a fakeredis one.
+    """
+
+    shared = True
+
+    def __init__(self, client, prefix="notes:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+def make_session_store(backend):
+    """Build the store for SESSION_BACKEND, or None to keep cookie sessions."""
+    if backend == "cookie":
+        return None
+    if backend == "memory":
+        return MemoryStore()
+    if backend == "file":
+        return FileStore(app.config["SESSION_FILE_DIR"])
+    if backend == "redis":
+        import redis  # only needed for this backend
+        return RedisStore(redis.Redis.from_url(app.config["SESSION_REDIS_URL"]))
+    raise ValueError("Unknown SESSION_BACKEND %r." % backend)
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session data kept in a store; the cookie only carries its random ID."""
+
+    def __init__(self, data=None, sid=None, stale=False):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(data, on_update)
+        self.sid = sid
+        # Written more than half a TTL ago, so it gets rewritten to extend its life
+        self.stale = stale
+        self.old_sid = None
+        self.modified = False
+        self.accessed = False
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+    def rotate(self):
+        """Move the data to a new ID, so an ID planted before login is worthless after it."""
+        if self.sid and not self.old_sid:
+            self.old_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keeps sessions in a store for SESSION_TTL seconds, writing them only when they change.
+
+    The cookie is only set when a session gets an ID or its life is extended,
+    so flash messages and other session writes no longer rewrite it.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        raw = self.store.get("session:" + sid) if sid else None
+        if raw is None:
+            return ServerSideSession()
+        record = self.serializer.loads(raw.decode())
+        stale = time.time() - record["written"] > app.config["SESSION_TTL"] / 2
+        return ServerSideSession(record["data"], sid, stale)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+        if session.old_sid:
+            self.store.delete("session:" + session.old_sid)
+        if not session:
+            if session.sid and session.modified:
+                self.store.delete("session:" + session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+                response.vary.add("Cookie")
+            return
+        if not (session.modified or session.stale):
+            return
+
+        ttl = app.config["SESSION_TTL"]
+        send_cookie = session.sid is None or session.stale
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        record = self.serializer.dumps({"written": time.time(), "data": dict(session)})
+        self.store.set("session:" + session.sid, record.encode(), ttl)
+        if send_cookie:
+            response.set_cookie(
+                name, session.sid,
+                expires=datetime.now(timezone.utc) + timedelta(seconds=ttl),
+                domain=domain, path=path,
+                secure=self.get_cookie_secure(app),
+                httponly=self.get_cookie_httponly(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+            response.vary.add("Cookie")
+
+session_store = make_session_store(app.config["SESSION_BACKEND"])
+if session_store:
+    app.session_interface = ServerSideSessionInterface(session_store)
+
+def rotate_session():
+    """Give a server-side session a new ID, e.g. at login."""
+    if isinstance(session._get_current_object(), ServerSideSession):
+        session.rotate()
+
 # User model for Flask-Login
 class User(UserMixin):
     def __init__(self, user_id, email, name):
@@ -24,40 +971,307 @@ class User(UserMixin):
         self.email = email
         self.name = name
 
+    @classmethod
+    def from_document(cls, doc):
+        return cls(str(doc["_id"]), doc["email"], doc["name"])
+
+class UserCache:
+    """Bounded LRU of User objects keyed by user ID, each entry living USER_CACHE_TTL seconds.
+
+    With a shared ``store`` (the file or Redis session store) a user cached by
+    one worker process is found by the others without a database lookup.
+    Call ``invalidate`` whenever a user's email or name changes.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self._entries[user_id]
+        raw = self.store.get("user:" + user_id) if self.store else None
+        if raw is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        data = json.loads(raw)
+        user = User(user_id, data["email"], data["name"])
+        self._remember(user)
+        with self._lock:
+            self.shared_hits += 1
+        return user
+
+    def set(self, user):
+        self._remember(user)
+        if self.store:
+            data = json.dumps({"email": user.email, "name": user.name}).encode()
+            self.store.set("user:" + user.id, data, app.config["USER_CACHE_TTL"])
+
+    def _remember(self, user):
+        with self._lock:
+            self._entries[user.id] = (user, time.monotonic() + app.config["USER_CACHE_TTL"])
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > app.config["USER_CACHE_SIZE"]:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+        if self.store and user_id:
+            self.store.delete("user:" + user_id)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "shared_hits": self.shared_hits,
+                    "misses": self.misses}
+
+user_cache = UserCache(session_store if session_store and session_store.shared else None)
+
 @login_manager.user_loader
 def load_user(user_id):
-    """Load user from the database by user ID."""
-    user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
+    """Load user by user ID, from the user cache or else the database."""
+    user = user_cache.get(user_id)
     if user:
-        return User(str(user["_id"]), user["email"], user["name"])
+        return user
+    doc = mongo.db.users.find_one({"_id": ObjectId(user_id)}, {"email": 1, "name": 1})
+    if doc:
+        user = User.from_document(doc)
+        user_cache.set(user)
+        return user
     return None
 
+# Full-text search
+TOKEN_RE = re.compile(r"\w+")
+
+def tokenize(text):
+    """Split text into lowercase word tokens."""
+    return [token.lower() for token in TOKEN_RE.findall(text or "")]
+
+class NoteSearchIndex:
+    """Inverted index over one user's notes: token -> {note id: term frequency}.
+
+    Notes are ranked with BM25. Every query term also matches the indexed
+    tokens it is a prefix of, at a lower weight than an exact match.
+    """
+
+    K1 = 1.2
+    B = 0.75
+    TAG_WEIGHT = 2
+    PREFIX_WEIGHT = 0.5
+
+    def __init__(self, notes_version=0):
+        self.postings = {}
+        self.doc_terms = {}
+        self.doc_lengths = {}
+        self.tokens = []  # sorted, for prefix lookups
+        self.total_length = 0
+        self.notes_version = notes_version  # the owner's notes_version the index reflects
+        self.lock = threading.Lock()
+
+    def add(self, note):
+        note_id = str(note["_id"])
+        self.remove(note_id)
+        terms = Counter(tokenize(note.get("note")))
+        for tag in note.get("tags") or []:
+            for token in tokenize(tag):
+                terms[token] += self.TAG_WEIGHT
+        self.doc_terms[note_id] = terms
+        self.doc_lengths[note_id] = sum(terms.values())
+        self.total_length += self.doc_lengths[note_id]
+        for token, tf in terms.items():
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = {}
+                bisect.insort(self.tokens, token)
+            postings[note_id] = tf
+
+    def remove(self, note_id):
+        terms = self.doc_terms.pop(note_id, None)
+        if not terms:
+            return
+        self.total_length -= self.doc_lengths.pop(note_id)
+        for token in terms:
+            postings = self.postings[token]
+            del postings[note_id]
+            if not postings:
+                del self.postings[token]
+                del self.tokens[bisect.bisect_left(self.tokens, token)]
+
+    def expand(self, term):
+        """Return the indexed tokens that start with ``term``."""
+        matches = []
+        for i in range(bisect.bisect_left(self.tokens, term), len(self.tokens)):
+            if not self.tokens[i].startswith(term):
+                break
+            matches.append(self.tokens[i])
+        return matches
+
+    def search(self, query, limit):
+        """Return up to ``limit`` (note id, score) pairs matching every query term."""
+        terms = tokenize(query)
+        if not terms or not self.doc_terms:
+            return []
+        doc_count = len(self.doc_terms)
+        avg_length = self.total_length / doc_count
+        scores = None
+        for term in terms:
+            term_scores = {}
+            for token in self.expand(term):
+                postings = self.postings[token]
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                weight = 1.0 if token == term else self.PREFIX_WEIGHT
+                for note_id, tf in postings.items():
+                    length = self.doc_lengths[note_id]
+                    norm = tf + self.K1 * (1 - self.B + self.B * length / avg_length)
+                    score = weight * idf * tf * (self.K1 + 1) / norm
+                    if score > term_scores.get(note_id, 0):
+                        term_scores[note_id] = score
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {note_id: scores[note_id] + score
+                          for note_id, score in term_scores.items() if note_id in scores}
+            if not scores:
+                return []
+        return heapq.nlargest(limit, scores.items(), key=itemgetter(1))
+
+class SearchIndexRegistry:
+    """Per-user NoteSearchIndex instances, built on first search and kept in an LRU.
+
+    Each index records the owner's notes_version. The note handlers of this
+    process apply their writes to it and count them, one per bump of the
+    version. A write made by another worker process leaves the index behind
+    the stored version, and the next search rebuilds it from the database.
+    """
+
+    def __init__(self):
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, notes_version):
+        """The user's index as of ``notes_version``, rebuilt only if it is behind or ahead."""
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index and index.notes_version == notes_version:
+                self._indexes.move_to_end(user_id)
+                return index
+        index = NoteSearchIndex(notes_version)
+        notes = listing_notes().find({"user_id": ObjectId(user_id)}, {"note": 1, "tags": 1})
+        for note in notes.batch_size(1000):
+            index.add(note)
+        with self._lock:
+            self._indexes[user_id] = index
+            while len(self._indexes) > app.config["SEARCH_INDEX_MAX_USERS"]:
+                self._indexes.popitem(last=False)
+        return index
+
+    def notes_changed(self, user_id, saved=(), removed=()):
+        """Apply one write, which bumped the user's notes_version once, to their index."""
+        index = self._indexes.get(user_id)
+        if index:
+            with index.lock:
+                for note in saved:
+                    index.add(note)
+                for note in removed:
+                    index.remove(str(note["_id"]))
+                index.notes_version += 1
+
+search_indexes = SearchIndexRegistry()
+
+def search_notes(user_id, query, notes_version=None):
+    """Return the user's notes matching ``query``, best match first.
+
+    ``notes_version`` is the user's notes_version if the caller already read it.
+    """
+    limit = app.config["SEARCH_RESULTS_LIMIT"]
+    if app.config["SEARCH_BACKEND"] == "memory":
+        if notes_version is None:
+            users = mongo.db.users.with_options(read_preference=listing_notes().read_preference)
+            notes_version = (users.find_one({"_id": ObjectId(user_id)}, {"notes_version": 1}) or {}).get("notes_version", 0)
+        index = search_indexes.get(user_id, notes_version)
+        with index.lock:
+            ranked = index.search(query, limit)
+        if not ranked:
+            return []
+        notes = listing_notes().find({
+            "_id": {"$in": [ObjectId(note_id) for note_id, _ in ranked]},
+            "user_id": ObjectId(user_id)
+        })
+        by_id = {str(note["_id"]): note for note in notes}
+        return [by_id[note_id] for note_id, _ in ranked if note_id in by_id]
+    return list(listing_notes().find(
+        {"user_id": ObjectId(user_id), "$text": {"$search": query}},
+        dict(NOTE_CARD_FIELDS, score={"$meta": "textScore"})
+    ).sort([("score", {"$meta": "textScore"})]).limit(limit))
+
+@app.template_filter("highlight")
+def highlight(text, terms):
+    """Escape ``text`` and wrap the words starting with any of ``terms`` in <mark>."""
+    if not terms:
+        return text
+    terms = tuple(terms)
+    text = text or ""
+    parts = []
+    pos = 0
+    for match in TOKEN_RE.finditer(text):
+        if match.group().lower().startswith(terms):
+            parts.append(escape(text[pos:match.start()]))
+            parts.append(Markup('<mark class="bg-yellow-200">%s</mark>') % match.group())
+            pos = match.end()
+    parts.append(escape(text[pos:]))
+    return Markup("").join(parts)
+
 # HTML Templates
-login_html = '''
+base_html = '''
 <!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Login - Notes App</title>
-    <link href="https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css" rel="stylesheet">
-    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
+    <title>{% block title %}Notes App{% endblock %}</title>
+    <link href="{{ asset_url('app.css') }}" rel="stylesheet">
+    {%- block head %}{% endblock %}
 </head>
-<body class="bg-gradient-to-r from-blue-50 to-blue-100 text-gray-800 flex items-center justify-center min-h-screen">
+<body class="bg-gradient-to-r from-blue-50 to-blue-100 text-gray-800 {% block body_class %}{% endblock %}">
+{%- block body %}{% endblock %}
+</body>
+</html>
+'''
+
+flash_html = '''
+{% with messages = get_flashed_messages(with_categories=true) %}
+    {% if messages %}
+        {% for category, message in messages %}
+            <div class="mb-4 p-4 rounded-lg {% if category == 'danger' %}bg-red-100 text-red-700{% else %}bg-green-100 text-green-700{% endif %}">
+                {{ message }}
+            </div>
+        {% endfor %}
+    {% endif %}
+{% endwith %}
+'''
+
+login_html = '''
+{% extends "base.html" %}
+{% block title %}Login - Notes App{% endblock %}
+{% block body_class %}flex items-center justify-center min-h-screen{% endblock %}
+{% block body %}
     <div class="bg-white p-8 rounded-lg shadow-xl w-96 transform hover:shadow-2xl transition duration-200">
         <h1 class="text-3xl font-bold mb-6 text-center text-blue-600">
             <i class="fas fa-sign-in-alt mr-2"></i>Login
         </h1>
         
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="mb-4 p-4 rounded-lg {% if category == 'danger' %}bg-red-100 text-red-700{% else %}bg-green-100 text-green-700{% endif %}">
-                        {{ message }}
-                    </div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
+        {% include "flash.html" %}
 
         <form action="/login" method="POST" class="space-y-4">
             <div>
@@ -89,35 +1303,20 @@ login_html = '''
             <a href="/register" class="text-blue-500 hover:text-blue-600 font-bold">Register</a>
         </p>
     </div>
-</body>
-</html>
+{% endblock %}
 '''
 
 register_html = '''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Register - Notes App</title>
-    <link href="https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css" rel="stylesheet">
-    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
-</head>
-<body class="bg-gradient-to-r from-blue-50 to-blue-100 text-gray-800 flex items-center justify-center min-h-screen">
+{% extends "base.html" %}
+{% block title %}Register - Notes App{% endblock %}
+{% block body_class %}flex items-center justify-center min-h-screen{% endblock %}
+{% block body %}
     <div class="bg-white p-8 rounded-lg shadow-xl w-96 transform hover:shadow-2xl transition duration-200">
         <h1 class="text-3xl font-bold mb-6 text-center text-blue-600">
             <i class="fas fa-user-plus mr-2"></i>Register
         </h1>
 
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="mb-4 p-4 rounded-lg {% if category == 'danger' %}bg-red-100 text-red-700{% else %}bg-green-100 text-green-700{% endif %}">
-                        {{ message }}
-                    </div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
+        {% include "flash.html" %}
 
         <form action="/register" method="POST" class="space-y-4">
             <div>
@@ -158,26 +1357,100 @@ register_html = '''
             <a href="/login" class="text-blue-500 hover:text-blue-600 font-bold">Login</a>
         </p>
     </div>
-</body>
-</html>
+{% endblock %}
+'''
+
+notes_cards_html = '''
+    {% for note in notes %}
+    <div id="note-{{ note._id }}" class="bg-white rounded-lg shadow-lg overflow-hidden transform hover:scale-105 transition duration-200 border-t-4 
+        {% if note.priority == 'High' %}border-red-500{% elif note.priority == 'Medium' %}border-yellow-500{% else %}border-green-500{% endif %}">
+        <div class="p-6">
+            <div class="flex items-center justify-between mb-4">
+                <span class="px-3 py-1 rounded-full text-sm font-semibold 
+                    {% if note.priority == 'High' %}bg-red-100 text-red-800
+                    {% elif note.priority == 'Medium' %}bg-yellow-100 text-yellow-800
+                    {% else %}bg-green-100 text-green-800{% endif %}">
+                    <i class="fas fa-flag mr-1"></i>{{ note.priority }}
+                </span>
+                <div class="flex space-x-2">
+                    <button class="text-blue-500 hover:text-blue-600 edit-btn" 
+                        data-id="{{ note._id }}" 
+                        data-note="{{ note.note }}" 
+                        data-tags="{{ note.tags | join(', ') }}" 
+                        data-priority="{{ note.priority }}"
+                        data-version="{{ note.version or 0 }}">
+                        <i class="fas fa-edit"></i>
+                    </button>
+                    <form action="/delete_note/{{ note._id }}" method="POST" class="inline delete-form">
+                        <button class="text-red-500 hover:text-red-600" 
+                            onclick="return confirm('Are you sure you want to delete this note?')">
+                            <i class="fas fa-trash"></i>
+                        </button>
+                    </form>
+                </div>
+            </div>
+            <p class="text-gray-800 mb-4">{{ note.note | highlight(terms) }}</p>
+            <div class="flex flex-wrap gap-2">
+                {% for tag in note.tags %}
+                    {% if tag.strip() %}
+                    <a href="{{ url_for('index', tag=tag.strip()) }}" class="px-2 py-1 bg-blue-100 text-blue-800 text-sm rounded-full hover:bg-blue-200">
+                        <i class="fas fa-tag mr-1"></i>{{ tag.strip() }}
+                    </a>
+                    {% endif %}
+                {% endfor %}
+            </div>
+            {% if note.attachments %}
+            <ul class="mt-4 space-y-2">
+                {% for attachment in note.attachments %}
+                <li class="flex items-center justify-between text-sm">
+                    <a href="/attachments/{{ attachment.id }}" class="flex items-center min-w-0 text-blue-600 hover:text-blue-800">
+                        {% if attachment.thumbnail %}
+                        <img src="/attachments/{{ attachment.id }}/thumbnail" alt="" loading="lazy" class="w-10 h-10 object-cover rounded mr-2">
+                        {% else %}
+                        <i class="fas fa-paperclip mr-2"></i>
+                        {% endif %}
+                        <span class="truncate">{{ attachment.filename }}</span>
+                    </a>
+                    <form action="/attachments/{{ attachment.id }}/delete" method="POST" class="inline attachment-form">
+                        <button class="text-gray-400 hover:text-red-600 ml-2" title="Remove attachment"
+                            onclick="return confirm('Remove this attachment?')">
+                            <i class="fas fa-times"></i>
+                        </button>
+                    </form>
+                </li>
+                {% endfor %}
+            </ul>
+            {% endif %}
+            <form action="/notes/{{ note._id }}/attachments" method="POST" enctype="multipart/form-data" class="mt-4 attachment-form">
+                <label class="cursor-pointer text-sm text-gray-500 hover:text-blue-600">
+                    <i class="fas fa-paperclip mr-1"></i>Attach a file
+                    <input type="file" name="file" class="hidden" onchange="this.form.requestSubmit()">
+                </label>
+            </form>
+        </div>
+    </div>
+    {% endfor %}
 '''
 
 index_html = '''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>My Notes</title>
-    <link href="https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css" rel="stylesheet">
-    <script src="https://cdn.jsdelivr.net/npm/alpinejs@3.12.0/dist/cdn.min.js" defer></script>
-    <script src="https://code.jquery.com/jquery-3.6.0.min.js"></script>
-    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
-</head>
-<body class="bg-gradient-to-r from-blue-50 to-blue-100 text-gray-800 min-h-screen">
+{% extends "base.html" %}
+{% block title %}My Notes{% endblock %}
+{% block head %}
+    <script src="{{ asset_url('notes.js') }}" defer></script>
+{% endblock %}
+{% block body_class %}min-h-screen{% endblock %}
+{% block body %}
     <nav class="bg-white shadow-lg">
         <div class="container mx-auto px-6 py-4 flex justify-between items-center">
             <h1 class="text-2xl font-bold text-blue-600">Welcome, {{ current_user.name }}</h1>
+            <form action="/search" method="GET" class="flex-1 max-w-md mx-6">
+                <div class="relative">
+                    <input type="search" name="q" value="{{ query or '' }}"
+                        class="shadow-sm focus:ring-2 focus:ring-blue-500 focus:border-blue-500 block w-full sm:text-sm border-gray-300 rounded-md p-2 pl-8"
+                        placeholder="Search notes and tags">
+                    <i class="fas fa-search absolute left-3 top-3 text-gray-400"></i>
+                </div>
+            </form>
             <div class="flex items-center space-x-4">
                 <span class="text-gray-600">
                     <i class="fas fa-user mr-2"></i>{{ current_user.email }}
@@ -191,16 +1464,16 @@ index_html = '''
 
     <div class="container mx-auto px-4 py-8">
         <!-- Flash Messages -->
-        <div x-data="{ show: true }" x-show="show" class="mb-6">
+        <div id="flashMessages" class="mb-6">
             {% with messages = get_flashed_messages(with_categories=true) %}
                 {% if messages %}
                     {% for category, message in messages %}
-                        <div class="animate-fade-in-down bg-{{ 'green' if category == 'success' else 'red' }}-100 border-l-4 border-{{ 'green' if category == 'success' else 'red' }}-500 text-{{ 'green' if category == 'success' else 'red' }}-700 p-4 rounded-lg shadow relative" role="alert">
+                        <div class="animate-fade-in-down {{ 'bg-green-100 border-green-500 text-green-700' if category == 'success' else 'bg-red-100 border-red-500 text-red-700' }} border-l-4 p-4 rounded-lg shadow relative" role="alert">
                             <div class="flex items-center">
-                                <i class="fas fa-{{ 'check-circle' if category == 'success' else 'exclamation-circle' }} mr-2"></i>
+                                <i class="fas {{ 'fa-check-circle' if category == 'success' else 'fa-exclamation-circle' }} mr-2"></i>
                                 <span class="block sm:inline">{{ message }}</span>
                             </div>
-                            <button @click="show = false" class="absolute top-0 right-0 p-4">
+                            <button type="button" data-dismiss class="absolute top-0 right-0 p-4">
                                 <i class="fas fa-times"></i>
                             </button>
                         </div>
@@ -209,92 +1482,148 @@ index_html = '''
             {% endwith %}
         </div>
 
-        <!-- Add Note Card -->
-        <div class="bg-white rounded-lg shadow-lg p-6 mb-8 transform hover:shadow-xl transition duration-200">
-            <h2 class="text-xl font-bold mb-4 text-gray-700 flex items-center">
-                <i class="fas fa-plus-circle mr-2 text-blue-500"></i>Add New Note
-            </h2>
-            <form action="/add_note" method="POST" class="space-y-4">
-                <div class="relative">
-                    <label class="block text-gray-700 text-sm font-bold mb-2" for="note">
-                        <i class="fas fa-pen mr-2"></i>Note Content
-                    </label>
-                    <textarea name="note" id="note" rows="3" required 
-                        class="shadow-sm focus:ring-2 focus:ring-blue-500 focus:border-blue-500 block w-full sm:text-sm border-gray-300 rounded-md p-2"
-                        placeholder="What's on your mind?"></textarea>
+        <div class="lg:flex lg:items-start lg:space-x-8">
+        {% if summary %}
+        <!-- Tag and Priority Summary -->
+        <aside class="lg:w-64 flex-shrink-0 mb-8">
+            <div class="bg-white rounded-lg shadow-lg p-6">
+                <a href="/" class="flex justify-between items-center font-bold text-gray-700 hover:text-blue-600 mb-4">
+                    <span><i class="fas fa-sticky-note mr-2 text-blue-500"></i>All notes</span>
+                    <span class="text-sm text-gray-500">{{ summary.total }}</span>
+                </a>
+                <h3 class="text-sm font-bold text-gray-500 uppercase tracking-wide mb-2">Priority</h3>
+                <ul class="space-y-1 mb-6">
+                    {% for priority, count in summary.priorities %}
+                    <li>
+                        <a href="{{ url_for('index', priority=None if filters.priority == priority else priority, tag=filters.tag) }}"
+                            class="flex justify-between items-center px-2 py-1 rounded {% if filters.priority == priority %}bg-blue-100 text-blue-800 font-semibold{% else %}text-gray-700 hover:bg-blue-50{% endif %}">
+                            <span><i class="fas fa-flag mr-2 {% if priority == 'High' %}text-red-500{% elif priority == 'Medium' %}text-yellow-500{% else %}text-green-500{% endif %}"></i>{{ priority }}</span>
+                            <span class="text-sm text-gray-500">{{ count }}</span>
+                        </a>
+                    </li>
+                    {% endfor %}
+                </ul>
+                <h3 class="text-sm font-bold text-gray-500 uppercase tracking-wide mb-2">Tags</h3>
+                {% if summary.tags %}
+                <div class="flex flex-wrap gap-2">
+                    {% for tag, count in summary.tags %}
+                    <a href="{{ url_for('index', tag=None if filters.tag == tag else tag, priority=filters.priority) }}"
+                        class="px-2 py-1 text-sm rounded-full {% if filters.tag == tag %}bg-blue-500 text-white{% else %}bg-blue-100 text-blue-800 hover:bg-blue-200{% endif %}">
+                        {{ tag }} <span class="opacity-75">{{ count }}</span>
+                    </a>
+                    {% endfor %}
                 </div>
+                {% else %}
+                <p class="text-sm text-gray-500">No tags yet.</p>
+                {% endif %}
+            </div>
+        </aside>
+        {% endif %}
 
-                <div class="grid grid-cols-1 md:grid-cols-2 gap-4">
-                    <div>
-                        <label class="block text-gray-700 text-sm font-bold mb-2" for="tags">
-                            <i class="fas fa-tags mr-2"></i>Tags
-                        </label>
-                        <input type="text" name="tags" id="tags" 
-                            class="shadow-sm focus:ring-2 focus:ring-blue-500 focus:border-blue-500 block w-full sm:text-sm border-gray-300 rounded-md"
-                            placeholder="work, personal, ideas">
-                    </div>
-
-                    <div>
-                        <label class="block text-gray-700 text-sm font-bold mb-2" for="priority">
-                            <i class="fas fa-flag mr-2"></i>Priority
+        <div class="flex-1 min-w-0">
+            <!-- Add Note Card -->
+            <div class="bg-white rounded-lg shadow-lg p-6 mb-8 transform hover:shadow-xl transition duration-200">
+                <h2 class="text-xl font-bold mb-4 text-gray-700 flex items-center">
+                    <i class="fas fa-plus-circle mr-2 text-blue-500"></i>Add New Note
+                </h2>
+                <form id="addForm" action="/add_note" method="POST" class="space-y-4">
+                    <div class="relative">
+                        <label class="block text-gray-700 text-sm font-bold mb-2" for="note">
+                            <i class="fas fa-pen mr-2"></i>Note Content
                         </label>
-                        <select name="priority" id="priority" 
-                            class="shadow-sm focus:ring-2 focus:ring-blue-500 focus:border-blue-500 block w-full sm:text-sm border-gray-300 rounded-md">
-                            <option value="Low">Low</option>
-                            <option value="Medium">Medium</option>
-                            <option value="High">High</option>
-                        </select>
+                        <textarea name="note" id="note" rows="3" required 
+                            class="shadow-sm focus:ring-2 focus:ring-blue-500 focus:border-blue-500 block w-full sm:text-sm border-gray-300 rounded-md p-2"
+                            placeholder="What's on your mind?"></textarea>
                     </div>
-                </div>
 
-                <button type="submit" class="w-full bg-blue-500 hover:bg-blue-600 text-white font-bold py-3 px-4 rounded-lg transition duration-200 flex items-center justify-center">
-                    <i class="fas fa-plus mr-2"></i>Add Note
-                </button>
-            </form>
-        </div>
+                    <div class="grid grid-cols-1 md:grid-cols-2 gap-4">
+                        <div>
+                            <label class="block text-gray-700 text-sm font-bold mb-2" for="tags">
+                                <i class="fas fa-tags mr-2"></i>Tags
+                            </label>
+                            <input type="text" name="tags" id="tags" 
+                                class="shadow-sm focus:ring-2 focus:ring-blue-500 focus:border-blue-500 block w-full sm:text-sm border-gray-300 rounded-md"
+                                placeholder="work, personal, ideas">
+                        </div>
 
-        <!-- Notes Grid -->
-        <div class="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-3 gap-6">
-            {% for note in notes %}
-            <div class="bg-white rounded-lg shadow-lg overflow-hidden transform hover:scale-105 transition duration-200 border-t-4 
-                {% if note.priority == 'High' %}border-red-500{% elif note.priority == 'Medium' %}border-yellow-500{% else %}border-green-500{% endif %}">
-                <div class="p-6">
-                    <div class="flex items-center justify-between mb-4">
-                        <span class="px-3 py-1 rounded-full text-sm font-semibold 
-                            {% if note.priority == 'High' %}bg-red-100 text-red-800
-                            {% elif note.priority == 'Medium' %}bg-yellow-100 text-yellow-800
-                            {% else %}bg-green-100 text-green-800{% endif %}">
-                            <i class="fas fa-flag mr-1"></i>{{ note.priority }}
-                        </span>
-                        <div class="flex space-x-2">
-                            <button class="text-blue-500 hover:text-blue-600 edit-btn" 
-                                data-id="{{ note._id }}" 
-                                data-note="{{ note.note }}" 
-                                data-tags="{{ note.tags | join(', ') }}" 
-                                data-priority="{{ note.priority }}">
-                                <i class="fas fa-edit"></i>
-                            </button>
-                            <form action="/delete_note/{{ note._id }}" method="POST" class="inline">
-                                <button class="text-red-500 hover:text-red-600" 
-                                    onclick="return confirm('Are you sure you want to delete this note?')">
-                                    <i class="fas fa-trash"></i>
-                                </button>
-                            </form>
+                        <div>
+                            <label class="block text-gray-700 text-sm font-bold mb-2" for="priority">
+                                <i class="fas fa-flag mr-2"></i>Priority
+                            </label>
+                            <select name="priority" id="priority" 
+                                class="shadow-sm focus:ring-2 focus:ring-blue-500 focus:border-blue-500 block w-full sm:text-sm border-gray-300 rounded-md">
+                                <option value="Low">Low</option>
+                                <option value="Medium">Medium</option>
+                                <option value="High">High</option>
+                            </select>
                         </div>
                     </div>
-                    <p class="text-gray-800 mb-4">{{ note.note }}</p>
-                    <div class="flex flex-wrap gap-2">
-                        {% for tag in note.tags %}
-                            {% if tag.strip() %}
-                            <span class="px-2 py-1 bg-blue-100 text-blue-800 text-sm rounded-full">
-                                <i class="fas fa-tag mr-1"></i>{{ tag.strip() }}
-                            </span>
-                            {% endif %}
+
+                    <button type="submit" class="w-full bg-blue-500 hover:bg-blue-600 text-white font-bold py-3 px-4 rounded-lg transition duration-200 flex items-center justify-center">
+                        <i class="fas fa-plus mr-2"></i>Add Note
+                    </button>
+                </form>
+            </div>
+
+            {% if query %}
+            <!-- Search Results -->
+            <div class="flex items-center justify-between mb-6">
+                <h2 class="text-xl font-bold text-gray-700">
+                    <i class="fas fa-search mr-2 text-blue-500"></i>{{ result_count }} result{{ '' if result_count == 1 else 's' }} for "{{ query }}"
+                </h2>
+                <a href="/" class="text-blue-500 hover:text-blue-600 font-bold">
+                    <i class="fas fa-arrow-left mr-1"></i>All notes
+                </a>
+            </div>
+            {% else %}
+            <!-- Filters -->
+            <form action="/" method="GET" class="flex flex-wrap items-end gap-4 mb-6">
+                <div>
+                    <label class="block text-gray-700 text-sm font-bold mb-2" for="filterPriority">
+                        <i class="fas fa-flag mr-2"></i>Priority
+                    </label>
+                    <select name="priority" id="filterPriority"
+                        class="shadow-sm focus:ring-2 focus:ring-blue-500 focus:border-blue-500 block w-full sm:text-sm border-gray-300 rounded-md">
+                        <option value="">All</option>
+                        {% for p in priorities %}
+                        <option value="{{ p }}" {% if p == filters.priority %}selected{% endif %}>{{ p }}</option>
                         {% endfor %}
-                    </div>
+                    </select>
+                </div>
+                <div>
+                    <label class="block text-gray-700 text-sm font-bold mb-2" for="filterTag">
+                        <i class="fas fa-tag mr-2"></i>Tag
+                    </label>
+                    <input type="text" name="tag" id="filterTag" value="{{ filters.tag or '' }}"
+                        class="shadow-sm focus:ring-2 focus:ring-blue-500 focus:border-blue-500 block w-full sm:text-sm border-gray-300 rounded-md"
+                        placeholder="work">
                 </div>
+                <button type="submit" class="bg-blue-500 hover:bg-blue-600 text-white font-bold py-2 px-4 rounded-lg transition duration-200">
+                    <i class="fas fa-filter mr-2"></i>Filter
+                </button>
+                {% if filters.priority or filters.tag %}
+                <a href="/" class="text-gray-600 hover:text-gray-800 py-2">
+                    <i class="fas fa-times mr-1"></i>Clear
+                </a>
+                {% endif %}
+            </form>
+            {% endif %}
+
+            <!-- Notes Grid -->
+            <div id="notesGrid" class="grid grid-cols-1 md:grid-cols-2 xl:grid-cols-3 gap-6"
+                {% if events_since %}data-events="/events?since={{ events_since }}"{% endif %}>
+                {% include "notes_cards.html" %}
+            </div>
+
+            <!-- Load More -->
+            {% if notes.next_cursor is defined %}{% set next_cursor = notes.next_cursor %}{% endif %}
+            <div class="mt-8 text-center">
+                <button id="loadMore" type="button" data-cursor="{{ next_cursor or '' }}"
+                    class="bg-white hover:bg-blue-50 text-blue-600 font-bold py-2 px-6 rounded-lg shadow transition duration-200 {% if not next_cursor %}hidden{% endif %}">
+                    <i class="fas fa-chevron-down mr-2"></i>Load more
+                </button>
             </div>
-            {% endfor %}
+        </div>
         </div>
     </div>
 
@@ -310,6 +1639,8 @@ index_html = '''
                 </div>
                 <form id="editForm" action="/edit_note" method="POST" class="p-6">
                     <input type="hidden" name="note_id" id="editNoteId">
+                    <input type="hidden" name="version" id="editVersion">
+                    <p id="editError" class="hidden mb-4 bg-red-100 border-l-4 border-red-500 text-red-700 p-3 rounded-lg"></p>
                     <div class="space-y-4">
                         <div>
                             <label for="editNote" class="block text-gray-700 font-medium mb-2">Note Content</label>
@@ -343,51 +1674,404 @@ index_html = '''
             </div>
         </div>
     </div>
-
-    <script>
-        // Modal functionality
-        const modal = document.getElementById('editModal');
-        
-        document.querySelectorAll('.edit-btn').forEach(button => {
-            button.addEventListener('click', function() {
-                modal.classList.remove('hidden');
-                document.getElementById('editNoteId').value = this.dataset.id;
-                document.getElementById('editNote').value = this.dataset.note;
-                document.getElementById('editTags').value = this.dataset.tags;
-                document.getElementById('editPriority').value = this.dataset.priority;
-            });
-        });
-
-        document.querySelectorAll('.close-modal').forEach(button => {
-            button.addEventListener('click', function() {
-                modal.classList.add('hidden');
-            });
-        });
-
-        // Close modal when clicking outside
-        modal.addEventListener('click', function(e) {
-            if (e.target === modal) {
-                modal.classList.add('hidden');
-            }
-        });
-
-        // Flash message auto-hide
-        setTimeout(() => {
-            const flashMessages = document.querySelectorAll('[role="alert"]');
-            flashMessages.forEach(message => {
-                message.style.display = 'none';
-            });
-        }, 5000);
-    </script>
-</body>
-</html>
+{% endblock %}
 '''
 
+TEMPLATES = {
+    "base.html": base_html,
+    "flash.html": flash_html,
+    "login.html": login_html,
+    "register.html": register_html,
+    "notes_cards.html": notes_cards_html,
+    "index.html": index_html,
+}
+
+# Templates are served by a loader rather than render_template_string so that
+# each one is parsed and compiled once and then reused from the environment's cache.
+app.jinja_loader = DictLoader(TEMPLATES)
+if app.config["TEMPLATE_BYTECODE_CACHE_DIR"]:
+    os.makedirs(app.config["TEMPLATE_BYTECODE_CACHE_DIR"], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config["TEMPLATE_BYTECODE_CACHE_DIR"])
+
+def precompile_templates():
+    """Compile every template up front so the first requests don't pay for it."""
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+
+if app.config["PRECOMPILE_TEMPLATES"]:
+    precompile_templates()
+
+# Static assets
+# Sources live in static/vendor and static/src. `flask build-assets` purges,
+# fingerprints and precompresses them into static/dist, which is served from
+# /assets with far-future cache headers, so no page depends on a CDN.
+ASSET_SOURCE_DIR = os.path.join(app.root_path, "static")
+ASSET_DIR = os.path.join(ASSET_SOURCE_DIR, "dist")
+ASSET_BUNDLES = {
+    "app.css": ["vendor/tailwindcss-2.2.7/tailwind.min.css", "vendor/fontawesome-free-6.0.0/css/all.min.css"],
+    "notes.js": ["src/notes.js"],
+}
+ASSET_FONTS = {"fa-solid-900.woff2": "vendor/fontawesome-free-6.0.0/webfonts/fa-solid-900.woff2"}
+ASSET_TYPES = {".css": "text/css", ".js": "text/javascript", ".woff2": "font/woff2"}
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+def load_asset_manifest():
+    """Map asset names to their fingerprinted builds, from static/dist/manifest.json."""
+    try:
+        with open(os.path.join(ASSET_DIR, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        app.logger.warning("static/dist/manifest.json is missing; run `flask build-assets`.")
+        return {}
+
+asset_manifest = load_asset_manifest()
+# Goes into the validators of cached pages, so a deploy that changes the
+# templates or assets never has clients keep a page from the previous one
+PAGE_BUILD = hashlib.sha1(json.dumps([TEMPLATES, asset_manifest], sort_keys=True).encode()).hexdigest()[:12]
+
+@app.template_global()
+def asset_url(name):
+    """URL of the fingerprinted build of an asset."""
+    return "/assets/" + asset_manifest.get(name, name)
+
+def find_asset(filename, accept_encodings):
+    """Return the file to send for a built asset, its content encoding and its mimetype.
+
+    Only fingerprinted names from the manifest are served. A precompressed
+    copy is picked when the client accepts brotli or gzip.
+    """
+    if filename not in asset_manifest.values():
+        raise NotFound()
+    path = os.path.join(ASSET_DIR, filename)
+    mimetype = ASSET_TYPES.get(os.path.splitext(filename)[1], "application/octet-stream")
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if accept_encodings[encoding] and os.path.isfile(path + suffix):
+            return path + suffix, encoding, mimetype
+    return path, None, mimetype
+
+def set_asset_headers(response, encoding):
+    """A fingerprinted asset never changes, so caches may keep it for a year without revalidating."""
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.content_encoding = encoding
+    return response
+
+@app.route("/assets/<filename>")
+def asset(filename):
+    path, encoding, mimetype = find_asset(filename, request.accept_encodings)
+    response = send_file(path, mimetype=mimetype, conditional=True, max_age=ASSET_MAX_AGE)
+    return set_asset_headers(response, encoding)
+
+def find_notes_page(user_id, after=None, priority=None, tag=None, limit=None, projection=None):
+    """Return one page of a user's notes, newest first, and the cursor for the next page.
+
+    Pagination is keyset based on ``_id`` so every page is an index range scan
+    no matter how deep into the listing the user is. A limit of 0 returns
+    every matching note.
+    """
+    limit = app.config["NOTES_PAGE_SIZE"] if limit is None else limit
+    query = notes_page_query(user_id, after, priority, tag)
+    cursor = listing_notes().find(query, projection).sort("_id", -1)
+    if not limit:
+        return list(cursor), None
+    return split_page(list(cursor.limit(limit + 1)), limit)
+
+class StreamedNotes:
+    """Iterates a notes cursor for a streamed page.
+
+    The cursor is drained in NOTES_CURSOR_BATCH_SIZE batches while the
+    template renders, so only one batch is in memory at a time.
+    ``next_cursor`` is known once iteration finishes.
+    """
+
+    def __init__(self, cursor, limit):
+        self._cursor = cursor
+        self.limit = limit
+        self.next_cursor = None
+
+    def __iter__(self):
+        last_id = None
+        for count, note in enumerate(self._cursor, 1):
+            if self.limit and count > self.limit:
+                self.next_cursor = str(last_id)
+                break
+            last_id = note["_id"]
+            yield note
+        self._cursor.close()
+
+def stream_notes_page(user_id, after=None, priority=None, tag=None):
+    """Return a StreamedNotes over one page (or all, with NOTES_PAGE_SIZE=0) of a user's notes."""
+    limit = app.config["NOTES_PAGE_SIZE"]
+    cursor = listing_notes().find(notes_page_query(user_id, after, priority, tag), NOTE_CARD_FIELDS)
+    cursor = cursor.sort("_id", -1).batch_size(app.config["NOTES_CURSOR_BATCH_SIZE"])
+    if limit:
+        cursor = cursor.limit(limit + 1)
+    return StreamedNotes(cursor, limit)
+
+def stream_template(name, **context):
+    """Render a template as a streamed response that flushes every STREAM_BUFFER_SIZE pieces."""
+    # Read the flashes now: the session is saved before the body is streamed
+    get_flashed_messages(with_categories=True)
+    template = app.jinja_env.get_template(name)
+    app.update_template_context(context)
+    stream = template.stream(context)
+    stream.enable_buffering(app.config["STREAM_BUFFER_SIZE"])
+
+    def generate():
+        started = time.perf_counter()
+        yield from stream
+        metrics.observe("notes_template_render_seconds", time.perf_counter() - started, template=name)
+
+    return Response(stream_with_context(generate()), mimetype="text/html")
+
+def notes_page_query(user_id, after=None, priority=None, tag=None):
+    """Build the filter for one page of a user's notes."""
+    query = {"user_id": ObjectId(user_id)}
+    if priority:
+        query["priority"] = priority
+    if tag:
+        query["tags"] = tag
+    if after:
+        query["_id"] = {"$lt": ObjectId(after)}
+    return query
+
+def split_page(notes, limit):
+    """Trim notes fetched with ``limit + 1`` to one page and return it with the next cursor."""
+    next_cursor = str(notes[limit - 1]["_id"]) if len(notes) > limit else None
+    return notes[:limit], next_cursor
+
+def listing_filters(args):
+    """Read the after/priority/tag listing parameters, ignoring an unknown priority.
+
+    Raises ValueError for a malformed cursor.
+    """
+    after = args.get("after") or None
+    priority = args.get("priority") or None
+    tag = (args.get("tag") or "").strip() or None
+    if after and not ObjectId.is_valid(after):
+        raise ValueError("Invalid cursor.")
+    if priority not in NOTE_PRIORITIES:
+        priority = None
+    return after, priority, tag
+
+def parse_tags(raw):
+    """Split a comma separated tag string into clean tags."""
+    return [tag.strip() for tag in (raw or "").split(",") if tag.strip()]
+
+def note_query(user_id, note_id, version=None):
+    """Filter for one of a user's notes, optionally only while it is at ``version``."""
+    query = {"_id": ObjectId(note_id), "user_id": ObjectId(user_id)}
+    if version is not None:
+        # Notes saved before versioning have no version field and count as version 0
+        query["version"] = version or None
+    return query
+
+class EditConflict(Exception):
+    """A versioned update found the note saved by someone else; ``note`` is the stored copy."""
+
+    def __init__(self, note):
+        super().__init__("This note was changed elsewhere. Save again to overwrite those changes.")
+        self.note = note
+
+def update_note(user_id, note_id, fields, version=None, projection=None):
+    """Set ``fields`` on a note and bump its version.
+
+    Returns the updated note and the note as it was before, or (None, None)
+    if the user has no such note. With ``version`` the update only applies
+    if the note is still at that version, otherwise EditConflict is raised.
+    """
+    previous = mongo.db.notes.find_one_and_update(
+        note_query(user_id, note_id, version),
+        {"$set": fields, "$inc": {"version": 1}},
+        projection=projection,
+        return_document=ReturnDocument.BEFORE
+    )
+    if previous is None:
+        if version is not None:
+            current = mongo.db.notes.find_one(note_query(user_id, note_id), projection)
+            if current:
+                raise EditConflict(current)
+        return None, None
+    return updated_note(previous, fields), previous
+
+def updated_note(previous, fields):
+    """The stored note after ``fields`` were set on ``previous`` and its version bumped."""
+    note = dict(previous, **fields)
+    note["version"] = previous.get("version", 0) + 1
+    return note
+
+def note_card(note, status=200, **extra):
+    """JSON answer to the page's fetch() calls carrying the re-rendered card of one note."""
+    html = render_template("notes_cards.html", notes=[note])
+    return jsonify(id=str(note["_id"]), version=note.get("version", 0), html=html, **extra), status
+
+# Every note write bumps the owner's notes_version, which validates cached pages
+NOTES_VERSION_BUMP = {"$inc": {"notes_version": 1}, "$currentDate": {"notes_modified": True}}
+
+def notes_changed(user_id, saved=(), removed=(), before=(), publish=True):
+    """Record a write to a user's notes and update the state derived from them.
+
+    ``saved`` are the inserted and updated notes as now stored, ``removed``
+    the deleted notes and ``before`` the previous versions of the updated ones.
+    With ``publish`` off no live update is sent; the caller publishes one later.
+    """
+    if not saved and not removed:
+        return
+    mongo.db.users.update_one({"_id": ObjectId(user_id)}, NOTES_VERSION_BUMP)
+    if publish:
+        publish_note_event(user_id, saved, removed)
+    update_note_counts(user_id, saved, list(removed) + list(before))
+    update_note_caches(user_id, saved, removed)
+    collect_attachments(removed)
+
+def update_note_caches(user_id, saved=(), removed=()):
+    """Propagate note writes to this process's in-memory state derived from the notes."""
+    search_indexes.notes_changed(user_id, saved, removed)
+
+# Per-user tag and priority counts, one {user_id, kind, key, count} document each
+def tally_notes(notes):
+    """Count the notes per (kind, key): each distinct tag and the priority."""
+    counts = Counter()
+    for note in notes:
+        for tag in set(note.get("tags") or ()):
+            counts["tag", tag] += 1
+        if note.get("priority"):
+            counts["priority", note["priority"]] += 1
+    return counts
+
+def update_note_counts(user_id, added=(), subtracted=()):
+    """Apply the difference between two sets of notes to the counts with $inc.
+
+    ``added`` are notes as now stored, ``subtracted`` notes as they were
+    before an update or delete. Counts that drop to zero are removed.
+    """
+    diff = tally_notes(added)
+    diff.subtract(tally_notes(subtracted))
+    changes = {key: count for key, count in diff.items() if count}
+    if not changes:
+        return
+    user_id = ObjectId(user_id)
+    mongo.db.note_counts.bulk_write([
+        UpdateOne({"user_id": user_id, "kind": kind, "key": key}, {"$inc": {"count": count}}, upsert=True)
+        for (kind, key), count in changes.items()
+    ], ordered=False)
+    if any(count < 0 for count in changes.values()):
+        mongo.db.note_counts.delete_many({"user_id": user_id, "count": {"$lte": 0}})
+
+def note_summary(user_id):
+    """The user's note count, their most used tags and the count of each priority."""
+    counts = mongo.db.note_counts.with_options(read_preference=listing_notes().read_preference)
+    user_id = ObjectId(user_id)
+    tags = counts.find({"user_id": user_id, "kind": "tag"}, {"key": 1, "count": 1})
+    priorities = {doc["key"]: doc["count"] for doc in counts.find({"user_id": user_id, "kind": "priority"})}
+    return {
+        "total": sum(priorities.values()),
+        "tags": [(doc["key"], doc["count"]) for doc in tags.sort("count", -1).limit(app.config["TAG_SUMMARY_LIMIT"])],
+        "priorities": [(priority, priorities.get(priority, 0)) for priority in NOTE_PRIORITIES],
+    }
+
+def notes_page_etag(user_id, notes_version, path):
+    """Validator for a page built from a user's notes: changes with every note write, the URL and the build."""
+    key = "%s:%s:%s:%s" % (PAGE_BUILD, user_id, notes_version, path)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def not_modified(req, etag, last_modified):
+    """True when the request's validators show the client's copy is current.
+
+    If-None-Match takes precedence over If-Modified-Since, as RFC 9110 requires.
+    """
+    if req.if_none_match:
+        return req.if_none_match.contains_weak(etag)
+    if req.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= req.if_modified_since
+    return False
+
+def set_notes_page_validators(response, etag, last_modified):
+    """Let the browser keep the page but revalidate it on every use."""
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
+
+def cached_notes_page(view):
+    """Answer conditional GETs for a page built from the current user's notes with 304.
+
+    One lookup of the user's notes_version replaces querying and rendering
+    the notes while nothing has changed. Pages with pending flash messages
+    are always rendered, since those are shown only once.
+    """
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if session.get("_flashes"):
+            return view(*args, **kwargs)
+        # Same read preference as the listing, so the version never runs ahead of the notes it covers
+        users = mongo.db.users.with_options(read_preference=listing_notes().read_preference)
+        state = users.find_one({"_id": ObjectId(current_user.id)}, {"notes_version": 1, "notes_modified": 1}) or {}
+        g.notes_version = state.get("notes_version", 0)
+        etag = notes_page_etag(current_user.id, g.notes_version, request.full_path)
+        last_modified = state.get("notes_modified")
+        if not_modified(request, etag, last_modified):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        return set_notes_page_validators(response, etag, last_modified)
+    return wrapped
+
 @app.route("/")
 @login_required
+@cached_notes_page
 def index():
-    notes = mongo.db.notes.find({"user_id": ObjectId(current_user.id)})
-    return render_template_string(index_html, notes=notes)
+    try:
+        after, priority, tag = listing_filters(request.args)
+    except ValueError:
+        abort(400)
+    if app.config["INDEX_STREAMING"] and not request.args.get("partial"):
+        return stream_template(
+            "index.html",
+            notes=stream_notes_page(current_user.id, after=after, priority=priority, tag=tag),
+            priorities=NOTE_PRIORITIES,
+            filters={"priority": priority, "tag": tag},
+            summary=note_summary(current_user.id),
+            events_since=app.config["LIVE_UPDATES"] and str(ObjectId()),
+        )
+    notes, next_cursor = find_notes_page(current_user.id, after=after, priority=priority, tag=tag,
+                                         projection=NOTE_CARD_FIELDS)
+    if request.args.get("partial"):
+        # "Load more" only needs the next batch of cards
+        return render_template("notes_cards.html", notes=notes), 200, {"X-Next-Cursor": next_cursor or ""}
+    return render_template(
+        "index.html",
+        notes=notes,
+        next_cursor=next_cursor,
+        priorities=NOTE_PRIORITIES,
+        filters={"priority": priority, "tag": tag},
+        summary=note_summary(current_user.id),
+        events_since=app.config["LIVE_UPDATES"] and str(ObjectId()),
+    )
+
+@app.route("/search")
+@login_required
+@cached_notes_page
+def search():
+    query = (request.args.get("q") or "").strip()
+    if not query:
+        return redirect(url_for("index"))
+    notes = search_notes(current_user.id, query, g.get("notes_version"))
+    return render_template(
+        "index.html",
+        notes=notes,
+        terms=tokenize(query),
+        next_cursor=None,
+        query=query,
+        result_count=len(notes),
+    )
 
 @app.route("/register", methods=["GET", "POST"])
 def register():
@@ -395,82 +2079,1406 @@ def register():
         name = request.form.get("name")
         email = request.form.get("email")
         password = request.form.get("password")
-        if mongo.db.users.find_one({"email": email}):
+        check_rate_limits("register", request.remote_addr, email)
+        # Cheap check first to spare a bcrypt; the unique index settles concurrent sign-ups
+        if mongo.db.users.find_one({"email": email}, {"_id": 1}):
+            flash("Email already registered.", "danger")
+            return redirect(url_for("register"))
+        hashed_password = hash_password(password)
+        try:
+            mongo.db.users.insert_one({"name": name, "email": email, "password": hashed_password})
+        except DuplicateKeyError:
             flash("Email already registered.", "danger")
             return redirect(url_for("register"))
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
-        mongo.db.users.insert_one({"name": name, "email": email, "password": hashed_password})
         flash("Registration successful.", "success")
         return redirect(url_for("login"))
-    return render_template_string(register_html)
+    return render_template("register.html")
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         email = request.form.get("email")
         password = request.form.get("password")
+        check_rate_limits("login", request.remote_addr, email)
         user = mongo.db.users.find_one({"email": email})
-        if user and bcrypt.check_password_hash(user["password"], password):
-            user_obj = User(str(user["_id"]), user["email"], user["name"])
+        if user and check_password(user["password"], password):
+            login_succeeded(email)
+            upgrade_password_hash(user, password)
+            user_obj = User.from_document(user)
+            rotate_session()
             login_user(user_obj)
+            user_cache.set(user_obj)
             flash("Login successful!", "success")
             return redirect(url_for("index"))
+        login_failed(email)
         flash("Invalid credentials.", "danger")
-    return render_template_string(login_html)
+    return render_template("login.html")
 
 @app.route("/logout")
 @login_required
 def logout():
+    user_cache.invalidate(current_user.id)
     logout_user()
     flash("Logged out successfully.", "info")
     return redirect(url_for("login"))
 
+# The note forms post normally, or through fetch() asking for JSON with just the changed card
 @app.route("/add_note", methods=["POST"])
 @login_required
 def add_note():
     note_content = request.form.get("note")
-    tags = [tag.strip() for tag in request.form.get("tags", "").split(",") if tag.strip()]
+    tags = parse_tags(request.form.get("tags"))
     priority = request.form.get("priority", "Low")
-    mongo.db.notes.insert_one({
+    note = {
         "user_id": ObjectId(current_user.id),
         "note": note_content,
         "tags": tags,
-        "priority": priority
-    })
+        "priority": priority,
+        "version": 1
+    }
+    mongo.db.notes.insert_one(note)
+    notes_changed(current_user.id, saved=[note])
+    if wants_json():
+        return note_card(note, 201)
     flash("Note added successfully.", "success")
     return redirect(url_for("index"))
 
 @app.route("/edit_note", methods=["POST"])
 @login_required
 def edit_note():
-    note_id = request.form.get("note_id")
-    note_content = request.form.get("note")
-    tags = [tag.strip() for tag in request.form.get("tags", "").split(",") if tag.strip()]
-    priority = request.form.get("priority", "Low")
-    
-    result = mongo.db.notes.update_one(
-        {"_id": ObjectId(note_id), "user_id": ObjectId(current_user.id)},
-        {"$set": {"note": note_content, "tags": tags, "priority": priority}}
-    )
-    
-    if result.modified_count > 0:
-        flash("Note updated successfully!", "success")
-    else:
-        flash("Error updating note.", "danger")
+    note_id = request.form.get("note_id") or ""
+    fields = {
+        "note": request.form.get("note"),
+        "tags": parse_tags(request.form.get("tags")),
+        "priority": request.form.get("priority", "Low")
+    }
+    # Forms from before versioning carry no version and keep last-write-wins
+    version = request.form.get("version", type=int)
+
+    note = previous = None
+    try:
+        if ObjectId.is_valid(note_id):
+            note, previous = update_note(current_user.id, note_id, fields, version, projection=NOTE_CARD_FIELDS)
+    except EditConflict as e:
+        if wants_json():
+            return note_card(e.note, 409, error=str(e))
+        flash(str(e), "danger")
+        return redirect(url_for("index"))
+
+    # A save that changes nothing still matches the note, so it is no longer reported as an error
+    if note is None:
+        if wants_json():
+            return jsonify(error="Note not found."), 404
+        flash("Note not found.", "danger")
+        return redirect(url_for("index"))
+    notes_changed(current_user.id, saved=[note], before=[previous])
+    if wants_json():
+        return note_card(note)
+    flash("Note updated successfully!", "success")
     return redirect(url_for("index"))
 
 @app.route("/delete_note/<note_id>", methods=["POST"])
 @login_required
 def delete_note(note_id):
-    result = mongo.db.notes.delete_one({
-        "_id": ObjectId(note_id),
-        "user_id": ObjectId(current_user.id)
-    })
-    if result.deleted_count == 0:
+    deleted = ObjectId.is_valid(note_id) and mongo.db.notes.find_one_and_delete(
+        note_query(current_user.id, note_id), {"tags": 1, "priority": 1}
+    )
+    if not deleted:
+        if wants_json():
+            return jsonify(error="Note not found or not authorized to delete."), 404
         flash("Note not found or not authorized to delete.", "danger")
     else:
+        notes_changed(current_user.id, removed=[deleted])
+        if wants_json():
+            return jsonify(id=note_id)
         flash("Note deleted successfully.", "success")
     return redirect(url_for("index"))
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape endpoint; requires ``Authorization: Bearer <METRICS_TOKEN>`` when that is set."""
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != "Bearer " + token:
+        abort(401)
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+def collect_app_metrics():
+    """Gauges and counters read from the user cache, the hashing pool, the event hub and the rate limiter."""
+    cache = user_cache.stats()
+    pool = password_hasher.stats()
+    streams = note_event_hub.stats()
+    limiter = rate_limiter.stats() if rate_limiter else {"allowed": 0}
+    return [
+        ("notes_user_cache_size", "gauge", {}, cache["size"]),
+        ("notes_user_cache_hits_total", "counter", {}, cache["hits"]),
+        ("notes_user_cache_shared_hits_total", "counter", {}, cache["shared_hits"]),
+        ("notes_user_cache_misses_total", "counter", {}, cache["misses"]),
+        ("notes_hash_pool_workers", "gauge", {}, pool["workers"]),
+        ("notes_hash_pool_queue_depth", "gauge", {}, pool["depth"]),
+        ("notes_hash_pool_queue_size", "gauge", {}, pool["queue_size"]),
+        ("notes_hash_pool_rejected_total", "counter", {}, pool["rejected"]),
+        ("notes_event_streams", "gauge", {}, streams["streams"]),
+        ("notes_event_stream_users", "gauge", {}, streams["users"]),
+        ("notes_rate_limit_allowed_total", "counter", {}, limiter["allowed"]),
+        ("notes_rate_limit_keys", "gauge", {}, limiter.get("keys", 0)),
+    ]
+
+metrics.collectors.append(collect_app_metrics)
+
+# JSON API
+NOTE_FIELDS = ("note", "tags", "priority")
+
+def note_to_json(note):
+    """Serialize a note document for the API, leaving out the owner."""
+    data = {"id": str(note["_id"])}
+    data.update((field, note[field]) for field in NOTE_FIELDS if field in note)
+    data["version"] = note.get("version", 0)
+    if "attachments" in note:
+        data["attachments"] = [attachment_to_json(attachment) for attachment in note["attachments"]]
+    return data
+
+def parse_note_fields(data, partial=False):
+    """Validate the note fields of an API payload.
+
+    Returns the fields to store; raises ValueError describing the first problem.
+    With ``partial`` only the fields present are validated and returned.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Note must be an object.")
+    fields = {}
+    if "note" in data or not partial:
+        if not isinstance(data.get("note"), str) or not data["note"].strip():
+            raise ValueError("'note' must be a non-empty string.")
+        fields["note"] = data["note"]
+    if "tags" in data or not partial:
+        tags = data.get("tags") or []
+        if isinstance(tags, str):
+            tags = tags.split(",")
+        if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+            raise ValueError("'tags' must be a list of strings or a comma separated string.")
+        fields["tags"] = [tag.strip() for tag in tags if tag.strip()]
+    if "priority" in data or not partial:
+        priority = data.get("priority", "Low")
+        if priority not in NOTE_PRIORITIES:
+            raise ValueError("'priority' must be one of %s." % ", ".join(NOTE_PRIORITIES))
+        fields["priority"] = priority
+    return fields
+
+def api_error(message, status):
+    return jsonify(error=message), status
+
+@app.route("/api/notes", methods=["GET"])
+@login_required
+def api_list_notes():
+    """One page of notes. Accepts after/priority/tag/limit and ``fields`` for projection."""
+    after = request.args.get("after") or None
+    if after and not ObjectId.is_valid(after):
+        return api_error("Invalid cursor.", 400)
+    priority = request.args.get("priority") or None
+    if priority and priority not in NOTE_PRIORITIES:
+        return api_error("Unknown priority.", 400)
+    limit = max(1, min(request.args.get("limit", app.config["NOTES_PAGE_SIZE"], type=int), 1000))
+    projection = None
+    if request.args.get("fields"):
+        fields = [field.strip() for field in request.args["fields"].split(",")]
+        if not set(fields) <= set(NOTE_FIELDS):
+            return api_error("'fields' may only contain %s." % ", ".join(NOTE_FIELDS), 400)
+        projection = {field: 1 for field in fields}
+        projection["version"] = 1
+
+    notes, next_cursor = find_notes_page(
+        current_user.id, after=after, priority=priority, tag=request.args.get("tag") or None,
+        limit=limit, projection=projection
+    )
+    response = jsonify(notes=[note_to_json(note) for note in notes], next_cursor=next_cursor)
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route("/api/notes", methods=["POST"])
+@login_required
+def api_create_note():
+    try:
+        note = parse_note_fields(request.get_json(silent=True))
+    except ValueError as e:
+        return api_error(str(e), 400)
+    note.update(user_id=ObjectId(current_user.id), version=1)
+    mongo.db.notes.insert_one(note)
+    notes_changed(current_user.id, saved=[note])
+    return jsonify(note_to_json(note)), 201
+
+@app.route("/api/notes/<note_id>", methods=["GET"])
+@login_required
+def api_get_note(note_id):
+    if not ObjectId.is_valid(note_id):
+        return api_error("Note not found.", 404)
+    note = mongo.db.notes.find_one({"_id": ObjectId(note_id), "user_id": ObjectId(current_user.id)})
+    if not note:
+        return api_error("Note not found.", 404)
+    response = jsonify(note_to_json(note))
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route("/api/notes/<note_id>", methods=["PATCH"])
+@login_required
+def api_update_note(note_id):
+    if not ObjectId.is_valid(note_id):
+        return api_error("Note not found.", 404)
+    data = request.get_json(silent=True)
+    try:
+        fields = parse_note_fields(data, partial=True)
+    except ValueError as e:
+        return api_error(str(e), 400)
+    # An optional "version" makes the update conditional on nobody having saved the note since
+    version = data.get("version")
+    if version is not None and (type(version) is not int or version < 0):
+        return api_error("'version' must be a non-negative integer.", 400)
+    try:
+        note, previous = update_note(current_user.id, note_id, fields, version)
+    except EditConflict as e:
+        return jsonify(error=str(e), note=note_to_json(e.note)), 409
+    if not note:
+        return api_error("Note not found.", 404)
+    notes_changed(current_user.id, saved=[note], before=[previous])
+    return jsonify(note_to_json(note))
+
+@app.route("/api/notes/<note_id>", methods=["DELETE"])
+@login_required
+def api_delete_note(note_id):
+    if not ObjectId.is_valid(note_id):
+        return api_error("Note not found.", 404)
+    note = mongo.db.notes.find_one_and_delete(note_query(current_user.id, note_id), {"tags": 1, "priority": 1})
+    if not note:
+        return api_error("Note not found.", 404)
+    notes_changed(current_user.id, removed=[note])
+    return "", 204
+
+@app.route("/api/tags", methods=["GET"])
+@login_required
+def api_tag_summary():
+    """Note counts per tag (most used first) and per priority."""
+    summary = note_summary(current_user.id)
+    return jsonify(
+        total=summary["total"],
+        tags=[{"tag": tag, "count": count} for tag, count in summary["tags"]],
+        priorities=[{"priority": priority, "count": count} for priority, count in summary["priorities"]],
+    )
+
+BULK_NOTE_FIELDS = ("note", "tags", "priority", "version")
+
+def bulk_conflicts(user_id, writes, positions):
+    """Positions of the updates and deletes in ``writes`` that matched no note.
+
+    Each one is filtered on the version read before the bulk_write, so a miss
+    means the note was saved or deleted elsewhere in between. bulk_write only
+    reports totals, so the notes are read back and compared with what this
+    request wrote; a note's later write landing means its earlier ones did.
+    """
+    note_ids = {previous["_id"] for _, write, _, previous in writes if not isinstance(write, InsertOne)}
+    current = {
+        note["_id"]: {field: note.get(field) for field in BULK_NOTE_FIELDS}
+        for note in mongo.db.notes.find({"_id": {"$in": list(note_ids)}, "user_id": user_id}, BULK_NOTE_FIELDS)
+    }
+    conflicts, landed = set(), set()
+    for position in sorted(positions, reverse=True):
+        _, write, note, previous = writes[position]
+        if isinstance(write, InsertOne) or previous["_id"] in landed:
+            continue
+        expected = None if note is None else {field: note.get(field) for field in BULK_NOTE_FIELDS}
+        if current.get(previous["_id"]) == expected:
+            landed.add(previous["_id"])
+        else:
+            conflicts.add(position)
+    return conflicts
+
+@app.route("/api/notes/bulk", methods=["POST"])
+@login_required
+def api_bulk_notes():
+    """Apply many inserts/updates/deletes with a single bulk_write.
+
+    Body: ``{"ordered": true, "operations": [{"op": "insert", "note": {...}},
+    {"op": "update", "id": "...", "note": {...}}, {"op": "delete", "id": "..."}]}``.
+    The response has one result per operation, in order. In ordered mode
+    processing stops at the first invalid or failed operation and the
+    remaining ones are reported as skipped. Updates and deletes only apply
+    to the version of the note read here; one saved elsewhere meanwhile is
+    reported as a conflict.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get("operations"), list):
+        return api_error("Expected an object with an 'operations' list.", 400)
+    operations = payload["operations"]
+    ordered = bool(payload.get("ordered", True))
+    if len(operations) > app.config["API_BULK_MAX_OPERATIONS"]:
+        return api_error("At most %d operations per request." % app.config["API_BULK_MAX_OPERATIONS"], 413)
+
+    user_id = ObjectId(current_user.id)
+    results = [{"index": i, "status": "skipped"} for i in range(len(operations))]
+
+    # One lookup tells which of the referenced notes exist and belong to the user
+    referenced = {op.get("id") for op in operations
+                  if isinstance(op, dict) and ObjectId.is_valid(op.get("id") or "")}
+    existing = {
+        str(note["_id"]): note
+        for note in mongo.db.notes.find(
+            {"_id": {"$in": [ObjectId(note_id) for note_id in referenced]}, "user_id": user_id},
+            {"note": 1, "tags": 1, "priority": 1, "version": 1}
+        )
+    } if referenced else {}
+
+    writes = []  # (operation index, pymongo write, note after it or None, note before it or None)
+    for i, op in enumerate(operations):
+        result = results[i]
+        try:
+            kind = op.get("op") if isinstance(op, dict) else None
+            if kind == "insert":
+                note = parse_note_fields(op.get("note"))
+                note.update(_id=ObjectId(), user_id=user_id, version=1)
+                writes.append((i, InsertOne(note), note, None))
+                existing[str(note["_id"])] = note
+                result.update(id=str(note["_id"]))
+                continue
+            if kind not in ("update", "delete"):
+                raise ValueError("'op' must be insert, update or delete.")
+            note_id = op.get("id")
+            result["id"] = note_id
+            if not ObjectId.is_valid(note_id or ""):
+                raise ValueError("'id' must be a note id.")
+            if note_id not in existing:
+                result["status"] = "not_found"
+                continue
+            previous = existing[note_id]
+            query = note_query(user_id, note_id, previous.get("version", 0))
+            if kind == "update":
+                fields = parse_note_fields(op.get("note"), partial=True)
+                existing[note_id] = updated_note(previous, fields)
+                writes.append((i, UpdateOne(query, {"$set": fields, "$inc": {"version": 1}}), existing[note_id], previous))
+            else:
+                writes.append((i, DeleteOne(query), None, existing.pop(note_id)))
+        except ValueError as e:
+            result.update(status="invalid", error=str(e))
+            if ordered:
+                break
+
+    failed, conflicts = {}, set()
+    if writes:
+        try:
+            outcome = mongo.db.notes.bulk_write([write for _, write, _, _ in writes], ordered=ordered).bulk_api_result
+        except BulkWriteError as e:
+            outcome = e.details
+            failed = {error["index"]: error["errmsg"] for error in e.details["writeErrors"]}
+        applied = [position for position in range(len(writes))
+                   if position not in failed and not (ordered and failed and position > min(failed))]
+        expected = sum(not isinstance(writes[position][1], InsertOne) for position in applied)
+        if outcome["nMatched"] + outcome["nRemoved"] < expected:
+            conflicts = bulk_conflicts(user_id, writes, applied)
+
+    saved, removed, before = [], [], []
+    for position, (i, write, note, previous) in enumerate(writes):
+        if position in failed:
+            results[i].update(status="error", error=failed[position])
+            continue
+        if ordered and failed and position > min(failed):
+            continue
+        if position in conflicts:
+            results[i].update(status="conflict", error="This note was changed elsewhere.")
+            continue
+        results[i]["status"] = {InsertOne: "inserted", UpdateOne: "updated", DeleteOne: "deleted"}[type(write)]
+        if note is None:
+            removed.append(previous)
+            continue
+        results[i]["version"] = note["version"]
+        saved.append(note)
+        if previous is not None:
+            before.append(previous)
+    notes_changed(current_user.id, saved=saved, removed=removed, before=before)
+
+    summary = Counter(result["status"] for result in results)
+    status = 200 if set(summary) <= {"inserted", "updated", "deleted"} else 207
+    return jsonify(ordered=ordered, summary=summary, results=results), status
+
+# Import and export
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_CHUNK_SIZE = 64 * 1024
+CSV_COLUMNS = ("id", "note", "tags", "priority", "version")
+IMPORT_ERRORS_KEPT = 20
+IMPORT_JOB_TTL = 7 * 24 * 3600  # finished jobs are removed after a week
+
+import_runner = ThreadPoolExecutor(max_workers=app.config["IMPORT_WORKERS"], thread_name_prefix="import")
+
+def export_notes(user_id, fmt):
+    """Yield a user's notes, oldest first, as NDJSON or CSV in chunks of about EXPORT_CHUNK_SIZE.
+
+    The cursor is drained in NOTES_CURSOR_BATCH_SIZE batches, so memory use
+    does not grow with the number of notes.
+    """
+    cursor = listing_notes().find({"user_id": ObjectId(user_id)}, {"note": 1, "tags": 1, "priority": 1, "version": 1})
+    cursor = cursor.sort("_id", 1).batch_size(app.config["NOTES_CURSOR_BATCH_SIZE"])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(CSV_COLUMNS)
+    for note in cursor:
+        data = note_to_json(note)
+        if fmt == "csv":
+            data["tags"] = ",".join(data.get("tags") or ())
+            writer.writerow([data.get(column, "") for column in CSV_COLUMNS])
+        else:
+            buffer.write(json.dumps(data) + "\n")
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+@app.route("/api/notes/export", methods=["GET"])
+@login_required
+def api_export_notes():
+    """Stream all of the user's notes as ``?format=ndjson`` (default) or ``csv``."""
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in EXPORT_FORMATS:
+        return api_error("'format' must be ndjson or csv.", 400)
+    filename = "notes-%s.%s" % (datetime.now(timezone.utc).strftime("%Y%m%d"), fmt)
+    return Response(
+        stream_with_context(export_notes(current_user.id, fmt)),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": 'attachment; filename="%s"' % filename},
+    )
+
+class ImportTooLarge(Exception):
+    """Raised when an upload is larger than IMPORT_MAX_BYTES."""
+
+def spool_upload(source, target, limit):
+    """Copy ``source`` to the file ``target`` in chunks and return the byte count."""
+    size = 0
+    while True:
+        chunk = source.read(EXPORT_CHUNK_SIZE)
+        if not chunk:
+            return size
+        size += len(chunk)
+        if size > limit:
+            raise ImportTooLarge()
+        target.write(chunk)
+
+def read_import(raw, fmt):
+    """Yield ``(line number, record)`` from an uploaded file, one record at a time.
+
+    A record is a dict of note fields, or the ValueError that made its line
+    unreadable. CSV files need a header row; empty cells take the defaults.
+    """
+    if fmt == "csv":
+        text = io.TextIOWrapper(raw, encoding="utf-8-sig", errors="replace", newline="")
+        reader = csv.DictReader(text)
+        try:
+            for row in reader:
+                yield reader.line_num, {key: value for key, value in row.items() if key and value}
+        finally:
+            text.detach()  # leave ``raw`` open for the caller
+        return
+    for number, line in enumerate(raw, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, ValueError("Not a JSON object.")
+
+def run_import(job_id, user_id, path, fmt):
+    """Background job: insert the notes of a spooled upload in IMPORT_BATCH_SIZE batches.
+
+    Progress is written to the job's document after every batch, so any
+    worker process can answer the polling requests.
+    """
+    jobs = mongo.db.import_jobs
+    owner = ObjectId(user_id)
+    progress = {"read": 0, "inserted": 0, "invalid": 0}
+    errors = []
+    batch = []
+    announced = []  # the imported notes for the job's one live update, until there are too many to list
+
+    def flush(raw):
+        if batch:
+            mongo.db.notes.insert_many(batch, ordered=False)
+            # Open tabs hear about the import once, when it ends
+            notes_changed(user_id, saved=batch, publish=False)
+            announced.extend(batch[:NOTE_EVENT_MAX_NOTES + 1 - len(announced)])
+            metrics.inc("notes_imported_notes_total", len(batch))
+            progress["inserted"] += len(batch)
+            batch.clear()
+        jobs.update_one({"_id": job_id}, {
+            "$set": dict(progress, bytes_read=raw.tell(), errors=errors),
+            "$currentDate": {"updated": True},
+        })
+
+    try:
+        with app.app_context(), open(path, "rb") as raw:
+            jobs.update_one({"_id": job_id}, {"$set": {"status": "running"}, "$currentDate": {"updated": True}})
+            for number, record in read_import(raw, fmt):
+                progress["read"] += 1
+                try:
+                    if isinstance(record, ValueError):
+                        raise record
+                    note = parse_note_fields(record)
+                except ValueError as e:
+                    progress["invalid"] += 1
+                    if len(errors) < IMPORT_ERRORS_KEPT:
+                        errors.append({"line": number, "error": str(e)})
+                    continue
+                note.update(_id=ObjectId(), user_id=owner, version=1)
+                batch.append(note)
+                if len(batch) >= app.config["IMPORT_BATCH_SIZE"]:
+                    flush(raw)
+            flush(raw)
+            status = {"status": "done"}
+    except Exception as e:
+        app.logger.exception("Import job %s failed", job_id)
+        status = {"status": "failed", "error": str(e), "errors": errors}
+        status.update(progress)
+    finally:
+        os.remove(path)
+    if announced:
+        publish_note_event(user_id, saved=announced)
+    metrics.inc("notes_import_jobs_total", status=status["status"])
+    jobs.update_one({"_id": job_id}, {"$set": status, "$currentDate": {"updated": True, "finished": True}})
+
+def import_job_json(job):
+    data = {"id": str(job["_id"])}
+    data.update((field, job.get(field)) for field in (
+        "status", "format", "bytes", "bytes_read", "read", "inserted", "invalid", "errors", "error"))
+    data["progress"] = round(job.get("bytes_read", 0) / job["bytes"], 4) if job.get("bytes") else 1.0
+    for field in ("created", "finished"):
+        data[field] = job[field].replace(tzinfo=timezone.utc).isoformat() if job.get(field) else None
+    return data
+
+@app.route("/api/notes/import", methods=["POST"])
+@login_required
+def api_import_notes():
+    """Queue an import of NDJSON or CSV notes and answer 202 with the job to poll.
+
+    The file is the request body or a multipart ``file`` field, in
+    ``?format=ndjson`` (default, or with Content-Type text/csv, ``csv``). It
+    is copied to a spool file in chunks and parsed by a background job, so
+    neither the request nor the job holds it in memory.
+    """
+    fmt = request.args.get("format") or ("csv" if request.mimetype == "text/csv" else "ndjson")
+    if fmt not in EXPORT_FORMATS:
+        return api_error("'format' must be ndjson or csv.", 400)
+    if request.mimetype == "multipart/form-data":
+        if "file" not in request.files:
+            return api_error("Expected the notes in a 'file' field.", 400)
+        source = request.files["file"].stream
+    else:
+        source = request.stream
+
+    spool = tempfile.NamedTemporaryFile(dir=app.config["IMPORT_SPOOL_DIR"], prefix="notes-import-",
+                                        suffix="." + fmt, delete=False)
+    try:
+        with spool:
+            size = spool_upload(source, spool, app.config["IMPORT_MAX_BYTES"])
+    except ImportTooLarge:
+        os.remove(spool.name)
+        return api_error("Imports are limited to %d bytes." % app.config["IMPORT_MAX_BYTES"], 413)
+    except BaseException:
+        os.remove(spool.name)
+        raise
+
+    job = {
+        "user_id": ObjectId(current_user.id), "format": fmt, "status": "queued", "bytes": size,
+        "bytes_read": 0, "read": 0, "inserted": 0, "invalid": 0, "errors": [],
+        "created": datetime.now(timezone.utc),
+    }
+    mongo.db.import_jobs.insert_one(job)
+    import_runner.submit(run_import, job["_id"], current_user.id, spool.name, fmt)
+    location = url_for("api_import_job", job_id=str(job["_id"]))
+    return jsonify(import_job_json(job)), 202, {"Location": location}
+
+@app.route("/api/imports/<job_id>", methods=["GET"])
+@login_required
+def api_import_job(job_id):
+    """Progress of one of the user's import jobs."""
+    job = ObjectId.is_valid(job_id) and mongo.db.import_jobs.find_one(
+        {"_id": ObjectId(job_id), "user_id": ObjectId(current_user.id)})
+    if not job:
+        return api_error("Import not found.", 404)
+    return jsonify(import_job_json(job))
+
+# Attachments: files in a GridFS bucket, each also listed on its note for the cards
+THUMBNAIL_TYPES = {"image/png", "image/jpeg", "image/gif", "image/webp"}
+ATTACHMENT_CHUNK_SIZE = 255 * 1024
+
+attachment_collector = ThreadPoolExecutor(max_workers=1, thread_name_prefix="attachment-gc")
+
+class AttachmentTooLarge(Exception):
+    """Raised when an upload is larger than ATTACHMENT_MAX_BYTES."""
+
+def attachment_bucket():
+    return gridfs.GridFSBucket(mongo.db, bucket_name="attachments", chunk_size_bytes=ATTACHMENT_CHUNK_SIZE)
+
+def attachment_type(filename, declared=None):
+    """The upload's declared content type, else one guessed from its name."""
+    if declared and declared != "application/octet-stream":
+        return declared
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+def attachment_to_json(attachment):
+    return {
+        "id": str(attachment["id"]),
+        "filename": attachment["filename"],
+        "content_type": attachment["content_type"],
+        "length": attachment["length"],
+        "url": "/attachments/%s" % attachment["id"],
+    }
+
+def store_attachment(user_id, note_id, source, filename, content_type):
+    """Stream ``source`` into GridFS in chunks and list the file on the note.
+
+    Returns the note with its attachments, or None if the user has no such
+    note. Raises AttachmentTooLarge past ATTACHMENT_MAX_BYTES; the chunks
+    written so far are removed.
+    """
+    if not mongo.db.notes.find_one(note_query(user_id, note_id), {"_id": 1}):
+        return None
+    metadata = {"user_id": ObjectId(user_id), "note_id": ObjectId(note_id), "content_type": content_type}
+    upload = attachment_bucket().open_upload_stream(filename, metadata=metadata)
+    size = 0
+    try:
+        while True:
+            chunk = source.read(ATTACHMENT_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > app.config["ATTACHMENT_MAX_BYTES"]:
+                raise AttachmentTooLarge()
+            upload.write(chunk)
+        upload.close()
+    except BaseException:
+        upload.abort()
+        raise
+
+    attachment = {"id": upload._id, "filename": filename, "content_type": content_type, "length": size,
+                  "thumbnail": content_type in THUMBNAIL_TYPES}
+    previous = mongo.db.notes.find_one_and_update(
+        note_query(user_id, note_id),
+        {"$push": {"attachments": attachment}, "$inc": {"version": 1}},
+        projection=NOTE_CARD_FIELDS
+    )
+    if previous is None:
+        # The note was deleted while the file was uploading
+        attachment_bucket().delete(upload._id)
+        return None
+    note = updated_note(previous, {"attachments": previous.get("attachments", []) + [attachment]})
+    notes_changed(user_id, saved=[note], before=[previous])
+    return note
+
+def remove_attachment(user_id, file_id):
+    """Take an attachment off its note and delete the file in the background.
+
+    Returns the note without it, or None if the user has no such attachment.
+    """
+    file_id = ObjectId(file_id)
+    previous = mongo.db.notes.find_one_and_update(
+        {"user_id": ObjectId(user_id), "attachments.id": file_id},
+        {"$pull": {"attachments": {"id": file_id}}, "$inc": {"version": 1}},
+        projection=NOTE_CARD_FIELDS
+    )
+    if previous is None:
+        return None
+    note = updated_note(previous, {"attachments": [a for a in previous["attachments"] if a["id"] != file_id]})
+    notes_changed(user_id, saved=[note], before=[previous])
+    attachment_collector.submit(delete_attachment_files, {"_id": file_id})
+    return note
+
+def collect_attachments(removed_notes):
+    """Delete the files of deleted notes in the background."""
+    if removed_notes:
+        query = {"metadata.note_id": {"$in": [note["_id"] for note in removed_notes]}}
+        attachment_collector.submit(delete_attachment_files, query)
+
+def delete_attachment_files(query):
+    """Background job: delete the attachment files matching ``query`` and their thumbnails."""
+    try:
+        file_ids = [file["_id"] for file in mongo.db["attachments.files"].find(query, {"_id": 1})]
+        bucket = attachment_bucket() if file_ids else None
+        for file_id in file_ids:
+            try:
+                bucket.delete(file_id)
+            except gridfs.errors.NoFile:
+                pass
+            thumbnails.discard(file_id)
+    except Exception:
+        app.logger.exception("Could not delete attachment files matching %s", query)
+
+def open_attachment(user_id, file_id):
+    """The user's attachment as a seekable GridOut, or None if they have no such file."""
+    if not ObjectId.is_valid(file_id):
+        return None
+    try:
+        grid_out = attachment_bucket().open_download_stream(ObjectId(file_id))
+    except gridfs.errors.NoFile:
+        return None
+    if (grid_out.metadata or {}).get("user_id") != ObjectId(user_id):
+        grid_out.close()
+        return None
+    return grid_out
+
+def content_disposition(disposition, filename):
+    """A Content-Disposition header value that carries any file name safely."""
+    return "%s; filename=\"%s\"; filename*=UTF-8''%s" % (
+        disposition, secure_filename(filename) or "attachment", quote(filename))
+
+class ThumbnailCache:
+    """Thumbnails of image attachments, made on first request and kept on disk.
+
+    When a new thumbnail takes the directory past ``max_bytes``, the least
+    recently served ones are deleted. Serving a thumbnail touches its file,
+    so modification times order the eviction. Pillow is only needed once a
+    thumbnail has to be made.
+    """
+
+    def __init__(self, directory, max_bytes, size):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = size
+        self._lock = threading.Lock()
+        self._bytes = None  # counted from the directory on the first write
+
+    def path(self, file_id, mimetype):
+        extension = "jpg" if mimetype == "image/jpeg" else "png"
+        return os.path.join(self.directory, "%s-%d.%s" % (file_id, self.size, extension))
+
+    def get(self, file_id, source, content_type):
+        """Return the thumbnail's path and type, or (None, None) if it cannot be made.
+
+        ``source`` is a readable, seekable image, only read on a cache miss.
+        """
+        mimetype = "image/jpeg" if content_type == "image/jpeg" else "image/png"
+        path = self.path(file_id, mimetype)
+        try:
+            os.utime(path)
+            return path, mimetype
+        except FileNotFoundError:
+            pass
+        try:
+            from PIL import Image
+        except ImportError:
+            return None, None
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f, Image.open(source) as image:
+                image.draft("RGB", (self.size, self.size))  # lets JPEGs decode at a fraction of full size
+                image.thumbnail((self.size, self.size))
+                if mimetype == "image/jpeg":
+                    image.convert("RGB").save(f, "JPEG", quality=85)
+                else:
+                    image.save(f, "PNG", optimize=True)
+            os.replace(temp_path, path)
+        except Exception as e:
+            os.remove(temp_path)
+            app.logger.warning("Could not make a thumbnail of attachment %s: %s", file_id, e)
+            return None, None
+        self._added(path)
+        return path, mimetype
+
+    def discard(self, file_id):
+        for mimetype in ("image/jpeg", "image/png"):
+            try:
+                os.remove(self.path(file_id, mimetype))
+            except FileNotFoundError:
+                pass
+
+    def _added(self, new_path):
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._disk_usage()[1]
+            else:
+                self._bytes += os.path.getsize(new_path)
+            if self._bytes <= self.max_bytes:
+                return
+            # Other processes share the directory, so evict from what is really on disk
+            entries, total = self._disk_usage()
+            for mtime, path, file_size in sorted(entries):
+                if total <= self.max_bytes * 0.9:
+                    break
+                if path == new_path:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= file_size
+            self._bytes = total
+
+    def _disk_usage(self):
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith((".jpg", ".png")):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries, sum(size for _, _, size in entries)
+
+thumbnails = ThumbnailCache(app.config["THUMBNAIL_CACHE_DIR"], app.config["THUMBNAIL_CACHE_MAX_BYTES"],
+                            app.config["THUMBNAIL_SIZE"])
+
+@app.route("/notes/<note_id>/attachments", methods=["POST"])
+@login_required
+def upload_attachment(note_id):
+    upload = request.files.get("file")
+    if not upload or not upload.filename:
+        if wants_json():
+            return jsonify(error="Choose a file to attach."), 400
+        flash("Choose a file to attach.", "danger")
+        return redirect(url_for("index"))
+    note = None
+    try:
+        if ObjectId.is_valid(note_id):
+            note = store_attachment(current_user.id, note_id, upload.stream, upload.filename,
+                                    attachment_type(upload.filename, upload.mimetype))
+    except AttachmentTooLarge:
+        message = "Attachments are limited to %d MB." % (app.config["ATTACHMENT_MAX_BYTES"] // (1024 * 1024))
+        if wants_json():
+            return jsonify(error=message), 413
+        flash(message, "danger")
+        return redirect(url_for("index"))
+    if note is None:
+        if wants_json():
+            return jsonify(error="Note not found."), 404
+        flash("Note not found.", "danger")
+        return redirect(url_for("index"))
+    if wants_json():
+        return note_card(note, 201)
+    flash("File attached.", "success")
+    return redirect(url_for("index"))
+
+@app.route("/attachments/<file_id>/delete", methods=["POST"])
+@login_required
+def delete_attachment(file_id):
+    note = remove_attachment(current_user.id, file_id) if ObjectId.is_valid(file_id) else None
+    if note is None:
+        if wants_json():
+            return jsonify(error="Attachment not found."), 404
+        flash("Attachment not found.", "danger")
+        return redirect(url_for("index"))
+    if wants_json():
+        return note_card(note)
+    flash("Attachment removed.", "success")
+    return redirect(url_for("index"))
+
+@app.route("/attachments/<file_id>")
+@login_required
+def download_attachment(file_id):
+    """Serve an attachment with Range and conditional GET support, straight from GridFS."""
+    grid_out = open_attachment(current_user.id, file_id)
+    if grid_out is None:
+        abort(404)
+    content_type = grid_out.metadata.get("content_type") or "application/octet-stream"
+    response = Response(FileWrapper(grid_out, ATTACHMENT_CHUNK_SIZE), mimetype=content_type, direct_passthrough=True)
+    response.content_length = grid_out.length
+    response.last_modified = grid_out.upload_date
+    response.set_etag(file_id)  # files never change, so the id identifies the content
+    response.cache_control.private = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    disposition = "inline" if content_type in THUMBNAIL_TYPES else "attachment"
+    response.headers["Content-Disposition"] = content_disposition(disposition, grid_out.filename)
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    return response.make_conditional(request, accept_ranges=True, complete_length=grid_out.length)
+
+@app.route("/attachments/<file_id>/thumbnail")
+@login_required
+def attachment_thumbnail(file_id):
+    grid_out = open_attachment(current_user.id, file_id)
+    if grid_out is None or grid_out.metadata.get("content_type") not in THUMBNAIL_TYPES:
+        abort(404)
+    with grid_out:
+        path, mimetype = thumbnails.get(file_id, grid_out, grid_out.metadata["content_type"])
+    try:
+        response = send_file(path, mimetype=mimetype, conditional=True, etag=file_id, max_age=ASSET_MAX_AGE)
+    except (TypeError, FileNotFoundError):
+        # No thumbnail (no Pillow, or not an image it reads), or another process just evicted it
+        return redirect(url_for("download_attachment", file_id=file_id))
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+@app.route("/api/notes/<note_id>/attachments", methods=["POST"])
+@login_required
+def api_upload_attachment(note_id):
+    """Attach a file: the raw request body (named by ``?filename=``) or a multipart ``file`` field.
+
+    The body is written to GridFS as it arrives, so large files are never held in memory.
+    """
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("file")
+        if not upload or not upload.filename:
+            return api_error("Expected the file in a 'file' field.", 400)
+        source, filename, declared = upload.stream, upload.filename, upload.mimetype
+    else:
+        source, filename, declared = request.stream, request.args.get("filename"), request.mimetype
+        if not filename:
+            return api_error("Name the file with ?filename=.", 400)
+    if not ObjectId.is_valid(note_id):
+        return api_error("Note not found.", 404)
+    try:
+        note = store_attachment(current_user.id, note_id, source, filename, attachment_type(filename, declared))
+    except AttachmentTooLarge:
+        return api_error("Attachments are limited to %d bytes." % app.config["ATTACHMENT_MAX_BYTES"], 413)
+    if note is None:
+        return api_error("Note not found.", 404)
+    return jsonify(attachment_to_json(note["attachments"][-1])), 201
+
+@app.route("/api/attachments/<file_id>", methods=["DELETE"])
+@login_required
+def api_delete_attachment(file_id):
+    if not ObjectId.is_valid(file_id) or remove_attachment(current_user.id, file_id) is None:
+        return api_error("Attachment not found.", 404)
+    return "", 204
+
+# Live updates: note changes pushed to the user's open tabs as server-sent events
+NOTE_EVENT_MAX_NOTES = 100  # larger writes (bulk, imports) just tell tabs to reload
+NOTE_EVENT_SKEW = timedelta(seconds=5)  # workers' clocks may disagree this much on event ids
+SSE_QUEUE_SIZE = 256
+
+def note_event(user_id, saved=(), removed=()):
+    """The note_events document announcing a write to a user's notes."""
+    event = {"user_id": ObjectId(user_id)}
+    if len(saved) + len(removed) <= NOTE_EVENT_MAX_NOTES:
+        event["saved"] = [{"id": str(note["_id"]), "version": note.get("version", 0)} for note in saved]
+        event["removed"] = [str(note["_id"]) for note in removed]
+    return event
+
+def publish_note_event(user_id, saved=(), removed=()):
+    """Tell the user's open tabs about a write, when live updates are on."""
+    if app.config["LIVE_UPDATES"]:
+        mongo.db.note_events.insert_one(note_event(user_id, saved, removed))
+
+def sse_message(event):
+    """Format a note event for an event stream; its id lets a reconnecting tab catch up."""
+    if "saved" in event:
+        data = {"saved": event["saved"], "removed": event["removed"]}
+    else:
+        data = {"reload": True}
+    return "id: %s\nevent: notes\ndata: %s\n\n" % (event["_id"], json.dumps(data))
+
+def missed_note_events(user_id, last_event_id):
+    """The user's events after ``last_event_id``; a single reload event if there are too many."""
+    if not last_event_id or not ObjectId.is_valid(last_event_id):
+        return []
+    events = list(mongo.db.note_events.find(
+        {"user_id": ObjectId(user_id), "_id": {"$gt": ObjectId(last_event_id)}}
+    ).sort("_id", 1).limit(NOTE_EVENT_MAX_NOTES + 1))
+    if len(events) > NOTE_EVENT_MAX_NOTES:
+        return [{"_id": events[-1]["_id"]}]
+    return events
+
+class NoteEventHub:
+    """Fans note events out to this process's open event streams.
+
+    A single watcher thread per process follows the note_events collection,
+    however many streams are open. It uses a change stream where the
+    deployment has them (replica sets and sharded clusters) and otherwise
+    tails the capped collection. Streams register a callback under their
+    user, so an idle stream costs a dict entry (and, in async mode, no
+    thread).
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._resume_token = None
+        self.source = None
+
+    def subscribe(self, user_id, deliver):
+        with self._lock:
+            self._subscribers.setdefault(str(user_id), set()).add(deliver)
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name="note-events", daemon=True)
+                self._watcher.start()
+
+    def unsubscribe(self, user_id, deliver):
+        with self._lock:
+            callbacks = self._subscribers.get(str(user_id))
+            if callbacks:
+                callbacks.discard(deliver)
+                if not callbacks:
+                    del self._subscribers[str(user_id)]
+
+    def publish(self, event):
+        with self._lock:
+            callbacks = list(self._subscribers.get(str(event["user_id"]), ()))
+        for deliver in callbacks:
+            deliver(event)
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._subscribers), "streams": sum(map(len, self._subscribers.values()))}
+
+    def _watch(self):
+        self.source = app.config["LIVE_UPDATES_SOURCE"]
+        while True:
+            try:
+                if self.source == "poll":
+                    self._follow_collection()
+                else:
+                    self._follow_change_stream()
+            except OperationFailure as e:
+                if self.source != "auto":
+                    app.logger.exception("Following note_events failed")
+                    time.sleep(1)
+                    continue
+                app.logger.info("No change streams on this deployment (%s); polling note_events instead", e)
+                self.source = "poll"
+            except Exception:
+                app.logger.exception("Following note_events failed")
+                time.sleep(1)
+
+    def _follow_change_stream(self):
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        with mongo.db.note_events.watch(pipeline, resume_after=self._resume_token) as stream:
+            for change in stream:
+                self._resume_token = stream.resume_token
+                self.publish(change["fullDocument"])
+
+    def _follow_collection(self):
+        """Tail the capped collection, or poll it once a second if it is not capped.
+
+        Events are read from a few seconds back and de-duplicated, so events
+        whose ids came from a worker with a slower clock are not skipped.
+        """
+        events = mongo.db.note_events
+        tailable = bool(events.options().get("capped"))
+        cursor_type = CursorType.TAILABLE_AWAIT if tailable else CursorType.NON_TAILABLE
+        seen = OrderedDict()
+        since = datetime.now(timezone.utc)
+        while True:
+            cursor = events.find({"_id": {"$gte": ObjectId.from_datetime(since - NOTE_EVENT_SKEW)}},
+                                 cursor_type=cursor_type)
+            while cursor.alive:
+                for event in cursor:
+                    if event["_id"] in seen:
+                        continue
+                    seen[event["_id"]] = True
+                    if len(seen) > 10000:
+                        seen.popitem(last=False)
+                    since = max(since, event["_id"].generation_time)
+                    self.publish(event)
+            time.sleep(1)
+
+note_event_hub = NoteEventHub()
+
+@app.route("/events")
+@login_required
+def note_events_stream():
+    """Server-sent events announcing writes to the user's notes from any tab, device or worker.
+
+    A reconnecting browser sends Last-Event-ID, and the page passes
+    ``?since=`` from when it was rendered, so no change in between is lost.
+    """
+    if not app.config["LIVE_UPDATES"]:
+        abort(404)
+    user_id = current_user.id
+    events = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+
+    def deliver(event):
+        try:
+            events.put_nowait(event)
+        except queue.Full:
+            pass  # a stalled client; it catches up with Last-Event-ID when it reconnects
+
+    # Subscribe first, so nothing written while the missed events are read falls in between
+    note_event_hub.subscribe(user_id, deliver)
+    try:
+        missed = missed_note_events(user_id, request.headers.get("Last-Event-ID") or request.args.get("since"))
+    except Exception:
+        note_event_hub.unsubscribe(user_id, deliver)
+        raise
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            for event in missed:
+                yield sse_message(event)
+            replayed = {event["_id"] for event in missed}
+            while True:
+                try:
+                    event = events.get(timeout=app.config["SSE_HEARTBEAT_SECONDS"])
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                if event["_id"] not in replayed:
+                    yield sse_message(event)
+        finally:
+            note_event_hub.unsubscribe(user_id, deliver)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/notes/<note_id>/card")
+@login_required
+def note_card_view(note_id):
+    """A note's card, for tabs that learn of a change from /events."""
+    note = ObjectId.is_valid(note_id) and mongo.db.notes.find_one(note_query(current_user.id, note_id), NOTE_CARD_FIELDS)
+    if not note:
+        return jsonify(error="Note not found."), 404
+    return note_card(note)
+
+# CLI
+@app.cli.command("init-db")
+def init_db_command():
+    """Create the MongoDB indexes."""
+    ensure_indexes()
+    click.echo("Indexes are in place.")
+
+def plan_summary(explain):
+    """Return the stages and index names found anywhere in an explain() winning plan."""
+    stages, indexes = [], []
+
+    def walk(node):
+        if isinstance(node, dict):
+            if "stage" in node:
+                stages.append(node["stage"])
+            if "indexName" in node:
+                indexes.append(node["indexName"])
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(explain.get("queryPlanner", {}).get("winningPlan", {}))
+    return stages, indexes
+
+@app.cli.command("check-indexes")
+@click.option("--user-id", help="User whose notes to explain the queries for (default: any user).")
+def check_indexes_command(user_id):
+    """Explain the app's main queries and flag any that scan a whole collection."""
+    if user_id is None:
+        user = mongo.db.users.find_one({}, {"_id": 1})
+        user_id = str(user["_id"]) if user else str(ObjectId())
+    owner = ObjectId(user_id)
+    checks = [
+        ("login/register: users by email", mongo.db.users.find({"email": "check@example.com"})),
+        ("index: notes page", listing_notes().find(notes_page_query(user_id)).sort("_id", -1).limit(31)),
+        ("index: next page", listing_notes().find(notes_page_query(user_id, after=str(ObjectId()))).sort("_id", -1).limit(31)),
+        ("index: by priority", listing_notes().find(notes_page_query(user_id, priority="High")).sort("_id", -1).limit(31)),
+        ("index: by tag", listing_notes().find(notes_page_query(user_id, tag="work")).sort("_id", -1).limit(31)),
+        ("index: tag summary", mongo.db.note_counts.find({"user_id": owner, "kind": "tag"}).sort("count", -1).limit(50)),
+    ]
+    if app.config["SEARCH_BACKEND"] == "mongo":
+        checks.append(("search: text", listing_notes().find({"user_id": owner, "$text": {"$search": "meeting"}})))
+    else:
+        checks.append(("search: index build", listing_notes().find({"user_id": owner}, {"note": 1, "tags": 1})))
+    failures = 0
+    for label, cursor in checks:
+        stages, indexes = plan_summary(cursor.explain())
+        full_scan = "COLLSCAN" in stages
+        in_memory_sort = "SORT" in stages
+        failures += full_scan
+        verdict = "COLLSCAN" if full_scan else ("in-memory sort" if in_memory_sort else "ok")
+        click.echo("%-34s %-10s %-40s %s" % (label, verdict, ", ".join(indexes) or "-", " > ".join(stages)))
+    if failures:
+        raise SystemExit(1)
+
+@app.cli.command("rebuild-note-counts")
+@click.option("--user-id", help="Only rebuild this user's counts (default: every user).")
+def rebuild_note_counts_command(user_id):
+    """Recount tags and priorities from the notes, e.g. after writes made outside the app."""
+    match = {"user_id": ObjectId(user_id)} if user_id else {}
+    run_id = ObjectId()
+    mongo.db.notes.aggregate([
+        {"$match": match},
+        {"$project": {"user_id": 1, "keys": {"$concatArrays": [
+            {"$map": {"input": {"$setUnion": [{"$ifNull": ["$tags", []]}, []]},
+                      "in": {"kind": "tag", "key": "$$this"}}},
+            {"$cond": [{"$ifNull": ["$priority", False]}, [{"kind": "priority", "key": "$priority"}], []]},
+        ]}}},
+        {"$unwind": "$keys"},
+        {"$group": {"_id": {"user_id": "$user_id", "kind": "$keys.kind", "key": "$keys.key"}, "count": {"$sum": 1}}},
+        {"$project": {"_id": 0, "user_id": "$_id.user_id", "kind": "$_id.kind", "key": "$_id.key",
+                      "count": 1, "rebuilt": run_id}},
+        {"$merge": {"into": "note_counts", "on": ["user_id", "kind", "key"],
+                    "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ])
+    stale = mongo.db.note_counts.delete_many(dict(match, rebuilt={"$ne": run_id}))
+    click.echo("Counts rebuilt; removed %d stale entries." % stale.deleted_count)
+
+@app.cli.command("gc-attachments")
+@click.option("--min-age", default=3600, show_default=True, help="Skip files uploaded less than this many seconds ago.")
+def gc_attachments_command(min_age):
+    """Delete attachment files that no note lists, e.g. left behind by a crash."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=min_age)
+    files = mongo.db["attachments.files"].find({"uploadDate": {"$lt": cutoff}}, {"_id": 1}).batch_size(1000)
+    removed = 0
+    while True:
+        batch = [file["_id"] for file in itertools.islice(files, 1000)]
+        if not batch:
+            break
+        listed = {a["id"] for note in mongo.db.notes.find({"attachments.id": {"$in": batch}}, {"attachments.id": 1})
+                  for a in note["attachments"]}
+        for file_id in set(batch) - listed:
+            delete_attachment_files({"_id": file_id})
+            removed += 1
+    click.echo("Removed %d unlisted attachment files." % removed)
+
+CSS_CLASS_RE = re.compile(r"\.((?:\\.|[\w-])+)")
+CLASS_TOKEN_RE = re.compile(r"[^\s\"'`<>=(),;{}]+")
+
+def split_css(css):
+    """Split a stylesheet into top-level (prelude, block) pairs.
+
+    ``block`` is None for statements and for /*! license comments, which are
+    the only comments kept.
+    """
+    items, depth, start, quote, i = [], 0, 0, None, 0
+    prelude_end = 0
+    while i < len(css):
+        char = css[i]
+        if quote:
+            if char == "\\":
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char == "\\":
+            i += 1
+        elif char in "\"'":
+            quote = char
+        elif css.startswith("/*", i):
+            end = css.index("*/", i) + 2
+            if depth == 0:
+                if css.startswith("/*!", i):
+                    items.append((css[i:end], None))
+                start = end
+            i = end
+            continue
+        elif char == "{":
+            if depth == 0:
+                prelude_end = i
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                items.append((css[start:prelude_end].strip(), css[prelude_end + 1:i]))
+                start = i + 1
+        elif char == ";" and depth == 0:
+            items.append((css[start:i + 1].strip(), None))
+            start = i + 1
+        i += 1
+    return items
+
+def split_selectors(prelude):
+    """Split a selector list on the commas that are not inside parentheses."""
+    parts, depth, start = [], 0, 0
+    for i, char in enumerate(prelude):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(prelude[start:i])
+            start = i + 1
+    parts.append(prelude[start:])
+    return parts
+
+def purge_css(css, used):
+    """Keep only the selectors whose classes all occur in ``used``."""
+    kept = []
+    for prelude, block in split_css(css):
+        if block is None:
+            kept.append(prelude)
+        elif prelude.startswith(("@media", "@supports")):
+            inner = purge_css(block, used)
+            if inner:
+                kept.append("%s{%s}" % (prelude, inner))
+        elif prelude.startswith("@"):
+            kept.append("%s{%s}" % (prelude, block))
+        else:
+            selectors = [
+                selector for selector in split_selectors(prelude)
+                if all(re.sub(r"\\(.)", r"\1", name) in used for name in CSS_CLASS_RE.findall(selector))
+            ]
+            if selectors:
+                kept.append("%s{%s}" % (",".join(selectors), block))
+    return "".join(kept)
+
+def prune_at_rules(css, fonts):
+    """Drop unused @keyframes and the @font-face rules for fonts that are not shipped.
+
+    The kept faces point at the fingerprinted woff2 builds in ``fonts``.
+    """
+    items = split_css(css)
+    body = "".join(block or "" for prelude, block in items if not prelude.startswith("@keyframes"))
+    kept = []
+    for prelude, block in items:
+        if prelude.startswith("@keyframes"):
+            if not re.search(r"animation[^;}]*\b%s\b" % re.escape(prelude.split()[1]), body):
+                continue
+        elif prelude.startswith("@font-face"):
+            shipped = [name for name in fonts if name in block]
+            if not shipped:
+                continue
+            block = re.sub(r"src:[^;}]*", 'src:url(%s) format("woff2")' % fonts[shipped[0]], block)
+        kept.append(prelude if block is None else "%s{%s}" % (prelude, block))
+    return "".join(kept)
+
+def minify_js(js):
+    """Drop comment lines, indentation and blank lines; enough for the hand-written page script."""
+    lines = (line.strip() for line in js.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("//")) + "\n"
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """Build the purged, fingerprinted and precompressed assets into static/dist."""
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        click.echo("brotli is not installed; writing gzip copies only.")
+
+    def read(source):
+        with open(os.path.join(ASSET_SOURCE_DIR, source), "rb") as f:
+            return f.read()
+
+    def write(name, data, compress=True):
+        stem, ext = os.path.splitext(name)
+        built = "%s.%s%s" % (stem, hashlib.sha256(data).hexdigest()[:12], ext)
+        copies = {built: data}
+        if compress:
+            copies[built + ".gz"] = gzip.compress(data, 9, mtime=0)
+            if brotli:
+                copies[built + ".br"] = brotli.compress(data, quality=11)
+        for filename, content in copies.items():
+            with open(os.path.join(ASSET_DIR, filename), "wb") as f:
+                f.write(content)
+        manifest[name] = built
+        click.echo("%-40s %9d bytes  %s" % (built, len(data), "  ".join(
+            "%s %d" % (filename.rsplit(".", 1)[1], len(content)) for filename, content in copies.items()
+            if filename != built)))
+        return copies
+
+    os.makedirs(ASSET_DIR, exist_ok=True)
+    manifest, written = {}, set()
+    for name, source in ASSET_FONTS.items():
+        written.update(write(name, read(source), compress=False))
+
+    # Every token of the templates and scripts that could be a class name
+    page_text = "".join(TEMPLATES.values()) + "".join(
+        read(source).decode() for name, sources in ASSET_BUNDLES.items() if name.endswith(".js") for source in sources)
+    used = set(CLASS_TOKEN_RE.findall(page_text))
+
+    for name, sources in ASSET_BUNDLES.items():
+        text = "".join(read(source).decode() for source in sources)
+        if name.endswith(".css"):
+            text = prune_at_rules(purge_css(text, used), manifest)
+        else:
+            text = minify_js(text)
+        written.update(write(name, text.encode()))
+
+    for filename in os.listdir(ASSET_DIR):
+        if filename not in written and filename != "manifest.json":
+            os.remove(os.path.join(ASSET_DIR, filename))
+    with open(os.path.join(ASSET_DIR, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write("\n")
+
 if __name__ == "__main__":
     app.run(debug=True)
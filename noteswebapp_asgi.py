@@ -0,0 +1,413 @@
+"""Async deployment mode: the notes app's pages as async Quart handlers on Motor.
+
+It shares templates, settings, the password hashing pool, the user cache and
+the session cookie with noteswebappBEST, so both modes can serve the same users
+side by side. Run it under an ASGI server, e.g.
+
+    hypercorn --workers 4 noteswebapp_asgi:app
+    uvicorn --workers 4 noteswebapp_asgi:app
+"""
+from functools import wraps
+import asyncio
+
+from quart import Quart, request, redirect, render_template, flash, url_for, session, abort, g, jsonify
+from quart import Response, make_response, send_file
+from quart.sessions import SessionInterface
+from motor.motor_asyncio import AsyncIOMotorClient
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from flask_login import AnonymousUserMixin
+
+import noteswebappBEST as notes_app
+
+app = Quart(__name__)
+for key in ("MONGO_URI", "SECRET_KEY", "NOTES_PAGE_SIZE", "SESSION_TTL", "LIVE_UPDATES", "SSE_HEARTBEAT_SECONDS"):
+    app.config[key] = notes_app.app.config[key]
+app.jinja_loader = notes_app.app.jinja_loader
+app.add_template_filter(notes_app.highlight, "highlight")
+app.add_template_global(notes_app.asset_url, "asset_url")
+
+db = None
+
+class AsyncSessionInterface(SessionInterface):
+    """Runs the sync app's server-side session interface off the event loop, so both modes share sessions."""
+
+    def __init__(self, interface):
+        self.interface = interface
+
+    async def open_session(self, app, request):
+        return await asyncio.to_thread(self.interface.open_session, app, request)
+
+    async def save_session(self, app, session, response):
+        await asyncio.to_thread(self.interface.save_session, app, session, response)
+
+if notes_app.session_store:
+    app.session_interface = AsyncSessionInterface(notes_app.app.session_interface)
+
+async def on_hash_pool(fn, *args):
+    """Await ``fn(*args)`` on the shared password hashing pool."""
+    return await asyncio.wrap_future(notes_app.password_hasher.submit(fn, *args))
+
+@app.errorhandler(notes_app.HashPoolFull)
+async def hash_pool_full(e):
+    return notes_app.hash_pool_full(e)
+
+async def rate_limiting(fn, *args):
+    """Call a rate limiting helper, off the event loop when its counts live in Redis."""
+    if notes_app.rate_limiter is not None and notes_app.rate_limiter.shared:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+@app.errorhandler(notes_app.RateLimited)
+async def rate_limited(e):
+    await flash(str(e), "danger")
+    return await render_template(request.endpoint + ".html"), 429, {"Retry-After": str(e.retry_after)}
+
+@app.before_serving
+async def connect():
+    """Open the Motor client on the server's event loop and make sure the indexes exist."""
+    global db
+    settings = notes_app.app.config
+    client = AsyncIOMotorClient(
+        app.config["MONGO_URI"],
+        maxPoolSize=settings["MONGO_MAX_POOL_SIZE"],
+        minPoolSize=settings["MONGO_MIN_POOL_SIZE"],
+        waitQueueTimeoutMS=settings["MONGO_WAIT_QUEUE_TIMEOUT_MS"],
+        event_listeners=[notes_app.MongoCommandTimer()],
+    )
+    db = client.get_default_database()
+    await asyncio.to_thread(notes_app.ensure_indexes)
+
+# Authentication, compatible with the session Flask-Login writes
+async def user_caching(fn, *args):
+    """Call a user cache method, off the event loop when the cache is backed by the session store."""
+    if notes_app.user_cache.store is not None:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+async def load_current_user():
+    user_id = session.get("_user_id")
+    if not user_id:
+        return None
+    user = await user_caching(notes_app.user_cache.get, user_id)
+    if user:
+        return user
+    doc = await db.users.find_one({"_id": ObjectId(user_id)}, {"email": 1, "name": 1})
+    if doc:
+        user = notes_app.User.from_document(doc)
+        await user_caching(notes_app.user_cache.set, user)
+    return user
+
+async def login_user(user):
+    if isinstance(session._get_current_object(), notes_app.ServerSideSession):
+        session.rotate()
+    session["_user_id"] = user.id
+    session["_fresh"] = True
+    await user_caching(notes_app.user_cache.set, user)
+
+async def logout_user():
+    await user_caching(notes_app.user_cache.invalidate, session.pop("_user_id", None))
+    session.pop("_fresh", None)
+
+def wants_json():
+    """True for the page's fetch() calls, which ask for JSON instead of a redirect."""
+    return request.accept_mimetypes.best == "application/json"
+
+def login_required(view):
+    @wraps(view)
+    async def wrapped(*args, **kwargs):
+        g.user = await load_current_user()
+        if g.user is None:
+            if wants_json():
+                return jsonify(error="Authentication required."), 401
+            await flash("Please log in to access this page.", "message")
+            return redirect(url_for("login", next=request.url))
+        return await view(*args, **kwargs)
+    return wrapped
+
+@app.context_processor
+def inject_current_user():
+    return {"current_user": g.get("user") or AnonymousUserMixin()}
+
+async def note_card(note, status=200, **extra):
+    """JSON answer to the page's fetch() calls carrying the re-rendered card of one note."""
+    html = await render_template("notes_cards.html", notes=[note])
+    return jsonify(id=str(note["_id"]), version=note.get("version", 0), html=html, **extra), status
+
+async def notes_changed(user_id, saved=(), removed=(), before=()):
+    """Record a write to a user's notes and update the state derived from them."""
+    if not saved and not removed:
+        return
+    await db.users.update_one({"_id": ObjectId(user_id)}, notes_app.NOTES_VERSION_BUMP)
+    if app.config["LIVE_UPDATES"]:
+        await db.note_events.insert_one(notes_app.note_event(user_id, saved, removed))
+    await asyncio.to_thread(notes_app.update_note_counts, user_id, saved, list(removed) + list(before))
+    notes_app.update_note_caches(user_id, saved, removed)
+    notes_app.collect_attachments(removed)
+
+def cached_notes_page(view):
+    """Answer conditional GETs for a page built from the current user's notes with 304."""
+    @wraps(view)
+    async def wrapped(*args, **kwargs):
+        if session.get("_flashes"):
+            return await view(*args, **kwargs)
+        read_preference = notes_app.READ_PREFERENCES[notes_app.app.config["MONGO_LISTING_READ_PREFERENCE"]]
+        users = db.users.with_options(read_preference=read_preference)
+        state = await users.find_one({"_id": ObjectId(g.user.id)}, {"notes_version": 1, "notes_modified": 1}) or {}
+        g.notes_version = state.get("notes_version", 0)
+        etag = notes_app.notes_page_etag(g.user.id, g.notes_version, request.full_path)
+        last_modified = state.get("notes_modified")
+        if notes_app.not_modified(request, etag, last_modified):
+            response = Response("", status=304)
+        else:
+            response = await make_response(await view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        return notes_app.set_notes_page_validators(response, etag, last_modified)
+    return wrapped
+
+# Routes
+@app.route("/")
+@login_required
+@cached_notes_page
+async def index():
+    try:
+        after, priority, tag = notes_app.listing_filters(request.args)
+    except ValueError:
+        abort(400)
+    limit = app.config["NOTES_PAGE_SIZE"]
+    query = notes_app.notes_page_query(g.user.id, after, priority, tag)
+    read_preference = notes_app.READ_PREFERENCES[notes_app.app.config["MONGO_LISTING_READ_PREFERENCE"]]
+    cursor = db.notes.with_options(read_preference=read_preference).find(query, notes_app.NOTE_CARD_FIELDS)
+    cursor = cursor.sort("_id", -1)
+    if limit:
+        notes = await cursor.limit(limit + 1).to_list(limit + 1)
+        notes, next_cursor = notes_app.split_page(notes, limit)
+    else:
+        notes, next_cursor = await cursor.to_list(None), None
+    if request.args.get("partial"):
+        return await render_template("notes_cards.html", notes=notes), 200, {"X-Next-Cursor": next_cursor or ""}
+    return await render_template(
+        "index.html",
+        notes=notes,
+        next_cursor=next_cursor,
+        priorities=notes_app.NOTE_PRIORITIES,
+        filters={"priority": priority, "tag": tag},
+        summary=await asyncio.to_thread(notes_app.note_summary, g.user.id),
+        events_since=app.config["LIVE_UPDATES"] and str(ObjectId()),
+    )
+
+@app.route("/search")
+@login_required
+@cached_notes_page
+async def search():
+    query = (request.args.get("q") or "").strip()
+    if not query:
+        return redirect(url_for("index"))
+    notes = await asyncio.to_thread(notes_app.search_notes, g.user.id, query, g.get("notes_version"))
+    return await render_template(
+        "index.html",
+        notes=notes,
+        terms=notes_app.tokenize(query),
+        next_cursor=None,
+        query=query,
+        result_count=len(notes),
+    )
+
+@app.route("/register", methods=["GET", "POST"])
+async def register():
+    if request.method == "POST":
+        form = await request.form
+        name = form.get("name")
+        email = form.get("email")
+        password = form.get("password")
+        await rate_limiting(notes_app.check_rate_limits, "register", request.remote_addr, email)
+        if await db.users.find_one({"email": email}, {"_id": 1}):
+            await flash("Email already registered.", "danger")
+            return redirect(url_for("register"))
+        hashed_password = await on_hash_pool(notes_app.bcrypt_hash, password)
+        try:
+            await db.users.insert_one({"name": name, "email": email, "password": hashed_password})
+        except DuplicateKeyError:
+            await flash("Email already registered.", "danger")
+            return redirect(url_for("register"))
+        await flash("Registration successful.", "success")
+        return redirect(url_for("login"))
+    return await render_template("register.html")
+
+@app.route("/login", methods=["GET", "POST"])
+async def login():
+    if request.method == "POST":
+        form = await request.form
+        email = form.get("email")
+        password = form.get("password")
+        await rate_limiting(notes_app.check_rate_limits, "login", request.remote_addr, email)
+        user = await db.users.find_one({"email": email})
+        if user and await on_hash_pool(notes_app.bcrypt.check_password_hash, user["password"], password):
+            await rate_limiting(notes_app.login_succeeded, email)
+            if notes_app.needs_rehash(user["password"]):
+                try:
+                    new_hash = await on_hash_pool(notes_app.bcrypt_hash, password)
+                    await db.users.update_one({"_id": user["_id"], "password": user["password"]},
+                                              {"$set": {"password": new_hash}})
+                except notes_app.HashPoolFull:
+                    pass
+            await login_user(notes_app.User.from_document(user))
+            await flash("Login successful!", "success")
+            return redirect(url_for("index"))
+        await rate_limiting(notes_app.login_failed, email)
+        await flash("Invalid credentials.", "danger")
+    return await render_template("login.html")
+
+@app.route("/logout")
+@login_required
+async def logout():
+    await logout_user()
+    await flash("Logged out successfully.", "info")
+    return redirect(url_for("login"))
+
+@app.route("/add_note", methods=["POST"])
+@login_required
+async def add_note():
+    form = await request.form
+    note = {
+        "user_id": ObjectId(g.user.id),
+        "note": form.get("note"),
+        "tags": notes_app.parse_tags(form.get("tags")),
+        "priority": form.get("priority", "Low"),
+        "version": 1
+    }
+    await db.notes.insert_one(note)
+    await notes_changed(g.user.id, saved=[note])
+    if wants_json():
+        return await note_card(note, 201)
+    await flash("Note added successfully.", "success")
+    return redirect(url_for("index"))
+
+@app.route("/edit_note", methods=["POST"])
+@login_required
+async def edit_note():
+    form = await request.form
+    note_id = form.get("note_id") or ""
+    fields = {
+        "note": form.get("note"),
+        "tags": notes_app.parse_tags(form.get("tags")),
+        "priority": form.get("priority", "Low")
+    }
+    version = form.get("version", type=int)
+
+    previous = None
+    if ObjectId.is_valid(note_id):
+        previous = await db.notes.find_one_and_update(
+            notes_app.note_query(g.user.id, note_id, version),
+            {"$set": fields, "$inc": {"version": 1}},
+            projection=notes_app.NOTE_CARD_FIELDS,
+            return_document=ReturnDocument.BEFORE
+        )
+        if previous is None and version is not None:
+            current = await db.notes.find_one(notes_app.note_query(g.user.id, note_id), notes_app.NOTE_CARD_FIELDS)
+            if current:
+                conflict = notes_app.EditConflict(current)
+                if wants_json():
+                    return await note_card(current, 409, error=str(conflict))
+                await flash(str(conflict), "danger")
+                return redirect(url_for("index"))
+
+    if previous is None:
+        if wants_json():
+            return jsonify(error="Note not found."), 404
+        await flash("Note not found.", "danger")
+        return redirect(url_for("index"))
+    note = notes_app.updated_note(previous, fields)
+    await notes_changed(g.user.id, saved=[note], before=[previous])
+    if wants_json():
+        return await note_card(note)
+    await flash("Note updated successfully!", "success")
+    return redirect(url_for("index"))
+
+@app.route("/delete_note/<note_id>", methods=["POST"])
+@login_required
+async def delete_note(note_id):
+    deleted = ObjectId.is_valid(note_id) and await db.notes.find_one_and_delete(
+        notes_app.note_query(g.user.id, note_id), {"tags": 1, "priority": 1}
+    )
+    if not deleted:
+        if wants_json():
+            return jsonify(error="Note not found or not authorized to delete."), 404
+        await flash("Note not found or not authorized to delete.", "danger")
+    else:
+        await notes_changed(g.user.id, removed=[deleted])
+        if wants_json():
+            return jsonify(id=note_id)
+        await flash("Note deleted successfully.", "success")
+    return redirect(url_for("index"))
+
+@app.route("/events")
+@login_required
+async def note_events_stream():
+    """Server-sent events for the user's notes; streams wait on the event loop, not on a thread each."""
+    if not app.config["LIVE_UPDATES"]:
+        abort(404)
+    user_id = g.user.id
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue(maxsize=notes_app.SSE_QUEUE_SIZE)
+
+    def put(event):
+        try:
+            events.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+    def deliver(event):
+        # Called on the hub's watcher thread
+        loop.call_soon_threadsafe(put, event)
+
+    notes_app.note_event_hub.subscribe(user_id, deliver)
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("since")
+    try:
+        missed = await asyncio.to_thread(notes_app.missed_note_events, user_id, last_event_id)
+    except Exception:
+        notes_app.note_event_hub.unsubscribe(user_id, deliver)
+        raise
+
+    async def stream():
+        try:
+            yield b"retry: 5000\n\n"
+            for event in missed:
+                yield notes_app.sse_message(event).encode()
+            replayed = {event["_id"] for event in missed}
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), app.config["SSE_HEARTBEAT_SECONDS"])
+                except asyncio.TimeoutError:
+                    yield b": heartbeat\n\n"
+                    continue
+                if event["_id"] not in replayed:
+                    yield notes_app.sse_message(event).encode()
+        finally:
+            notes_app.note_event_hub.unsubscribe(user_id, deliver)
+
+    response = await make_response(stream(), {"Content-Type": "text/event-stream",
+                                              "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.timeout = None
+    return response
+
+@app.route("/notes/<note_id>/card")
+@login_required
+async def note_card_view(note_id):
+    note = ObjectId.is_valid(note_id) and await db.notes.find_one(
+        notes_app.note_query(g.user.id, note_id), notes_app.NOTE_CARD_FIELDS
+    )
+    if not note:
+        return jsonify(error="Note not found."), 404
+    return await note_card(note)
+
+@app.route("/assets/<filename>")
+async def asset(filename):
+    path, encoding, mimetype = notes_app.find_asset(filename, request.accept_encodings)
+    response = await send_file(path, mimetype=mimetype, conditional=True, cache_timeout=notes_app.ASSET_MAX_AGE)
+    return notes_app.set_asset_headers(response, encoding)
+
+if __name__ == "__main__":
+    app.run(debug=True)
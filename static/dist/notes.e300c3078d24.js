@@ -0,0 +1,201 @@
+const modal = document.getElementById('editModal');
+document.getElementById('notesGrid').addEventListener('click', function(e) {
+const button = e.target.closest('.edit-btn');
+if (!button) {
+return;
+}
+modal.classList.remove('hidden');
+document.getElementById('editNoteId').value = button.dataset.id;
+document.getElementById('editNote').value = button.dataset.note;
+document.getElementById('editTags').value = button.dataset.tags;
+document.getElementById('editPriority').value = button.dataset.priority;
+document.getElementById('editVersion').value = button.dataset.version;
+document.getElementById('editError').classList.add('hidden');
+});
+const grid = document.getElementById('notesGrid');
+const messageClasses = {
+success: 'bg-green-100 border-green-500 text-green-700',
+danger: 'bg-red-100 border-red-500 text-red-700',
+info: 'bg-blue-100 border-blue-500 text-blue-700'
+};
+function showMessage(category, text) {
+const alert = document.createElement('div');
+alert.className = 'animate-fade-in-down border-l-4 p-4 rounded-lg shadow mb-2 ' + messageClasses[category];
+alert.setAttribute('role', 'alert');
+alert.textContent = text;
+document.getElementById('flashMessages').prepend(alert);
+setTimeout(() => alert.remove(), 5000);
+}
+function sendForm(form) {
+return fetch(form.action, {
+method: 'POST',
+body: new FormData(form),
+headers: {'Accept': 'application/json'},
+credentials: 'same-origin'
+}).then(response => response.json()
+.catch(() => ({}))
+.then(data => ({status: response.status, data})));
+}
+function cardFrom(html) {
+const template = document.createElement('template');
+template.innerHTML = html.trim();
+return template.content.firstElementChild;
+}
+document.getElementById('addForm').addEventListener('submit', function(e) {
+e.preventDefault();
+sendForm(this).then(({status, data}) => {
+if (status !== 201) {
+showMessage('danger', data.error || 'Error adding note.');
+return;
+}
+if (window.location.pathname === '/' && !window.location.search) {
+grid.prepend(cardFrom(data.html));
+}
+this.reset();
+showMessage('success', 'Note added successfully.');
+}).catch(() => this.submit());
+});
+document.getElementById('editForm').addEventListener('submit', function(e) {
+e.preventDefault();
+const error = document.getElementById('editError');
+sendForm(this).then(({status, data}) => {
+const card = document.getElementById('note-' + document.getElementById('editNoteId').value);
+if (card && data.html) {
+card.replaceWith(cardFrom(data.html));
+}
+if (status === 409) {
+document.getElementById('editVersion').value = data.version;
+error.textContent = data.error;
+error.classList.remove('hidden');
+return;
+}
+modal.classList.add('hidden');
+if (status === 200) {
+showMessage('success', 'Note updated successfully!');
+} else {
+if (card && status === 404) {
+card.remove();
+}
+showMessage('danger', data.error || 'Error updating note.');
+}
+}).catch(() => this.submit());
+});
+grid.addEventListener('submit', function(e) {
+const form = e.target.closest('.delete-form');
+if (!form) {
+return;
+}
+e.preventDefault();
+sendForm(form).then(({status, data}) => {
+const card = form.closest('[id^="note-"]');
+if (status === 200 || status === 404) {
+card.remove();
+}
+if (status === 200) {
+showMessage('success', 'Note deleted successfully.');
+} else {
+showMessage('danger', data.error || 'Error deleting note.');
+}
+}).catch(() => form.submit());
+});
+grid.addEventListener('submit', function(e) {
+const form = e.target.closest('.attachment-form');
+if (!form) {
+return;
+}
+e.preventDefault();
+sendForm(form).then(({status, data}) => {
+if (data.html) {
+form.closest('[id^="note-"]').replaceWith(cardFrom(data.html));
+}
+if (status === 201) {
+showMessage('success', 'File attached.');
+} else if (status === 200) {
+showMessage('success', 'Attachment removed.');
+} else {
+showMessage('danger', data.error || 'Error updating attachments.');
+}
+}).catch(() => form.submit());
+});
+function refreshCard(id, version) {
+const card = document.getElementById('note-' + id);
+const button = card && card.querySelector('.edit-btn');
+if (button && Number(button.dataset.version) >= version) {
+return;
+}
+if (!card && (version !== 1 || window.location.pathname !== '/' || window.location.search)) {
+return;
+}
+fetch('/notes/' + id + '/card', {headers: {'Accept': 'application/json'}, credentials: 'same-origin'})
+.then(response => response.ok ? response.json() : null)
+.then(data => {
+if (!data) {
+return;
+}
+const current = document.getElementById('note-' + id);
+if (current) {
+current.replaceWith(cardFrom(data.html));
+} else {
+grid.prepend(cardFrom(data.html));
+}
+});
+}
+if (grid.dataset.events && window.EventSource) {
+const events = new EventSource(grid.dataset.events);
+events.addEventListener('notes', function(e) {
+const data = JSON.parse(e.data);
+if (data.reload) {
+showMessage('info', 'Your notes changed elsewhere. Reload the page to see the changes.');
+return;
+}
+data.removed.forEach(id => {
+const card = document.getElementById('note-' + id);
+if (card) {
+card.remove();
+}
+});
+data.saved.forEach(note => refreshCard(note.id, note.version));
+});
+}
+const loadMore = document.getElementById('loadMore');
+loadMore.addEventListener('click', function() {
+const params = new URLSearchParams(window.location.search);
+params.set('after', this.dataset.cursor);
+params.set('partial', '1');
+this.disabled = true;
+fetch('/?' + params.toString(), {credentials: 'same-origin'})
+.then(response => {
+const cursor = response.headers.get('X-Next-Cursor');
+return response.text().then(html => ({html, cursor}));
+})
+.then(({html, cursor}) => {
+document.getElementById('notesGrid').insertAdjacentHTML('beforeend', html);
+this.dataset.cursor = cursor || '';
+this.classList.toggle('hidden', !cursor);
+})
+.finally(() => {
+this.disabled = false;
+});
+});
+document.querySelectorAll('.close-modal').forEach(button => {
+button.addEventListener('click', function() {
+modal.classList.add('hidden');
+});
+});
+modal.addEventListener('click', function(e) {
+if (e.target === modal) {
+modal.classList.add('hidden');
+}
+});
+document.getElementById('flashMessages').addEventListener('click', function(e) {
+const button = e.target.closest('[data-dismiss]');
+if (button) {
+button.closest('[role="alert"]').remove();
+}
+});
+setTimeout(() => {
+const flashMessages = document.querySelectorAll('[role="alert"]');
+flashMessages.forEach(message => {
+message.style.display = 'none';
+});
+}, 5000);
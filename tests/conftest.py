@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The app reads its settings at import; PyMongo does not connect until a query runs
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/notes_test")
+os.environ.setdefault("SECRET_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,198 @@
+"""Server-side session stores, the session interface and the shared user cache."""
+import time
+
+import fakeredis
+import pytest
+from flask import Flask, session
+
+from noteswebappBEST import (FileStore, MemoryStore, RedisStore, ServerSideSessionInterface, User, UserCache,
+                             rotate_session)
+
+
+class CountingStore:
+    """Wraps a store and records the keys written and deleted."""
+
+    shared = True
+
+    def __init__(self, store):
+        self.store = store
+        self.writes = []
+        self.deletes = []
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, ttl):
+        self.writes.append(key)
+        self.store.set(key, value, ttl)
+
+    def delete(self, key):
+        self.deletes.append(key)
+        self.store.delete(key)
+
+
+@pytest.fixture(params=["memory", "file", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStore()
+    if request.param == "file":
+        return FileStore(str(tmp_path / "sessions"))
+    return RedisStore(fakeredis.FakeRedis())
+
+
+def test_store_get_set_delete(store):
+    assert store.get("missing") is None
+    store.set("key", b"value", 60)
+    assert store.get("key") == b"value"
+    store.set("key", b"other", 60)
+    assert store.get("key") == b"other"
+    store.delete("key")
+    assert store.get("key") is None
+    store.delete("key")  # deleting a missing key is fine
+
+
+@pytest.mark.parametrize("backend", ["memory", "file"])
+def test_expired_keys_are_not_returned(backend, tmp_path):
+    store = MemoryStore() if backend == "memory" else FileStore(str(tmp_path))
+    store.set("key", b"value", -1)
+    assert store.get("key") is None
+
+
+def test_redis_store_expires_keys_itself():
+    client = fakeredis.FakeRedis()
+    RedisStore(client, prefix="p:").set("key", b"value", 30)
+    assert 0 < client.ttl("p:key") <= 30
+
+
+@pytest.fixture
+def sessions():
+    """A small app using the server-side session interface over a fake Redis."""
+    store = CountingStore(RedisStore(fakeredis.FakeRedis()))
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY="test", SESSION_TTL=3600)
+    app.session_interface = ServerSideSessionInterface(store)
+
+    @app.route("/read")
+    def read():
+        return session.get("value", "")
+
+    @app.route("/write/<value>")
+    def write(value):
+        session["value"] = value
+        return ""
+
+    @app.route("/login")
+    def login():
+        rotate_session()
+        session["_user_id"] = "user"
+        return ""
+
+    @app.route("/clear")
+    def clear():
+        session.clear()
+        return ""
+
+    return app.test_client(), store
+
+
+def session_cookie(client):
+    cookie = client.get_cookie("session")
+    return cookie.value if cookie else None
+
+
+def test_untouched_session_is_not_stored(sessions):
+    client, store = sessions
+    response = client.get("/read")
+    assert "Set-Cookie" not in response.headers
+    assert store.writes == []
+
+
+def test_session_is_written_only_when_it_changes(sessions):
+    client, store = sessions
+    response = client.get("/write/a")
+    sid = session_cookie(client)
+    assert "Set-Cookie" in response.headers
+    assert store.writes == ["session:" + sid]
+
+    response = client.get("/read")
+    assert response.data == b"a"
+    assert "Set-Cookie" not in response.headers
+    assert "Cookie" in response.vary
+    assert len(store.writes) == 1
+
+    # A changed session is stored again under the same ID, without a new cookie
+    response = client.get("/write/b")
+    assert "Set-Cookie" not in response.headers
+    assert store.writes == ["session:" + sid] * 2
+    assert client.get("/read").data == b"b"
+
+
+def test_login_moves_the_session_to_a_new_id(sessions):
+    client, store = sessions
+    client.get("/write/a")
+    planted = session_cookie(client)
+    client.get("/login")
+    sid = session_cookie(client)
+    assert sid != planted
+    assert store.get("session:" + planted) is None
+    assert "session:" + planted in store.deletes
+    assert client.get("/read").data == b"a"
+
+
+def test_stale_session_is_rewritten_with_a_fresh_cookie(sessions):
+    client, store = sessions
+    client.get("/write/a")
+    sid = session_cookie(client)
+    # Pretend the session was written more than half a SESSION_TTL ago
+    serializer = ServerSideSessionInterface.serializer
+    record = serializer.loads(store.get("session:" + sid).decode())
+    record["written"] = time.time() - 2000
+    store.store.set("session:" + sid, serializer.dumps(record).encode(), 3600)
+
+    response = client.get("/read")
+    assert response.data == b"a"
+    assert "Set-Cookie" in response.headers
+    assert session_cookie(client) == sid
+    record = serializer.loads(store.get("session:" + sid).decode())
+    assert time.time() - record["written"] < 60
+
+
+def test_emptied_session_is_deleted(sessions):
+    client, store = sessions
+    client.get("/write/a")
+    sid = session_cookie(client)
+    response = client.get("/clear")
+    assert store.get("session:" + sid) is None
+    assert "session=;" in response.headers["Set-Cookie"]
+    assert session_cookie(client) is None
+
+
+def test_unknown_session_id_starts_an_empty_session(sessions):
+    client, store = sessions
+    client.set_cookie("session", "forged")
+    assert client.get("/read").data == b""
+    assert store.writes == []
+
+
+def test_user_cache_shares_users_through_the_store():
+    store = RedisStore(fakeredis.FakeRedis())
+    first, second = UserCache(store), UserCache(store)
+    first.set(User("u1", "a@example.com", "A"))
+
+    user = second.get("u1")
+    assert (user.id, user.email, user.name) == ("u1", "a@example.com", "A")
+    assert second.stats()["shared_hits"] == 1
+    assert second.get("u1") is user  # now in its own LRU
+    assert second.stats()["hits"] == 1
+
+    first.invalidate("u1")
+    assert first.get("u1") is None
+    assert UserCache(store).get("u1") is None
+
+
+def test_user_cache_without_store_stays_local():
+    first, second = UserCache(), UserCache()
+    first.set(User("u1", "a@example.com", "A"))
+    assert first.get("u1").email == "a@example.com"
+    assert second.get("u1") is None
+    assert second.stats()["misses"] == 1